@@ -14,6 +14,10 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
+import collections
+import hashlib
+import io
+import os
 import sys
 import re
 
@@ -55,20 +59,39 @@ OPCODES = {
     "XOR":  {"type": 2, "code": "10101011"},
 }
 
-# Regex for matching lines
-# Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+# Compiled once rather than on every line
+REG_RE = re.compile(r"R([0-7])")
+LABEL_RE = re.compile(r"(\w+):")
 
-# Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+# Opcode name -> (type, opcode byte)
+OPCODE_BYTES = {name: (info["type"], int(info["code"], 2))
+                for name, info in OPCODES.items()}
+
+# Register operand -> register number
+REGISTERS = {f"R{r}": r for r in range(8)}
+
+
+class AssemblerError(Exception):
+    """
+    Raised by assemble() for errors in the source. status is the exit
+    status the command line assembler uses for the error.
+    """
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [inputfile] [outputfile]
+
+    Returns the input and output file names and whether -O was given.
     """
 
+    optimize = "-O" in argv[1:]
+    argv = [arg for arg in argv if arg != "-O"]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,321 +105,562 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [infile.asm] [outfile.ls8]", file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, optimize
+
+
+# Kinds of item tokenize() yields:
+#   (LABEL, name)
+#   (DATA, bytes, notes)        notes yields the listing comment for each byte
+#   (OP, opcode, args, operands, line number)
+# args holds register numbers and the LDI immediate, which is either a byte
+# or the name of a label, and operands is the operand text as written.
+LABEL = 0
+DATA = 1
+OP = 2
 
+# Instructions that never fall through to the next one
+NO_FALLTHROUGH = {"HLT", "JMP", "RET", "IRET"}
 
-def open_files(inputfile, outputfile):
+
+def tokenize(inputfile):
     """
-    Open files for reading and writing. If either of the files are named "-",
-    stdin or stdout is returned as appropriate.
+    Read source a line at a time and yield the label, data and instruction
+    items it holds, for link() to turn into machine code. Errors in the
+    source raise AssemblerError.
     """
 
-    if inputfile == "-":
-        inputfile = sys.stdin
-    else:
-        inputfile = open(inputfile)
+    line_num = 0
 
-    if outputfile == "-":
-        outputfile = sys.stdout
-    else:
-        outputfile = open(outputfile, "w")
+    def fail(message, status):
+        raise AssemblerError(f"Line {line_num}: {message}", status)
 
-    return inputfile, outputfile
+    def get_reg(op):
+        reg = REGISTERS.get(op)
+        if reg is None:
+            # anything starting with R0-R7 is accepted, as it always was
+            m = REG_RE.match(op)
+            if m is None:
+                fail(f"unknown register {op}", 1)
+            reg = int(m.group(1))
+        return reg
 
+    for line in inputfile:
+        line_num += 1
 
-def normalize_line(groups):
-    """
-    Takes match groups and uppercases them if they're not None.
-    """
+        # Strip comments and whitespace, ignore blank lines
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
+        line = line.strip()
+        if line == '':
+            continue
 
-    result = []
+        # Track label address
+        colon = line.find(':')
+        if colon > 0:
+            m = LABEL_RE.match(line)
+            if m is not None and m.end() == colon + 1:
+                yield (LABEL, m.group(1).upper())
+                line = line[colon + 1:].lstrip()
+                if line == '':
+                    continue
+
+        # Ignore lines that don't start with an opcode
+        if not (line[0].isalnum() or line[0] == '_'):
+            continue
+
+        parts = line.split(None, 1)
+        opcode = parts[0].upper()
 
-    for g in groups:
-        if g is None:
-            result.append(None)
+        if opcode == 'DS':
+            if len(parts) == 1:
+                fail("missing argument to DS", 2)
+            data = parts[1]
+            # one note per character
+            yield (DATA, data.encode("latin-1"), data)
+            continue
+
+        if opcode == 'DB':
+            if len(parts) == 1:
+                fail("missing argument to DB", 2)
+            data = parts[1]
+            try:
+                val = int(data, 0)
+            except ValueError:
+                fail("invalid integer argument to DB", 2)
+            # Force to byte size
+            yield (DATA, bytes([val & 0xff]), (data,))
+            continue
+
+        info = OPCODE_BYTES.get(opcode)
+        if info is None:
+            fail(f"unknown opcode {opcode}", 2)
+        op_type = info[0]
+
+        if len(parts) == 1:
+            operands = []
+        else:
+            operands = [op.strip().upper() for op in parts[1].split(',')]
+
+        desired = 2 if op_type == 8 else op_type
+        if len(operands) < desired:
+            fail(f"missing operand to {opcode}", 1)
+        elif len(operands) > desired:
+            fail(f"unexpected operand to {opcode}", 1)
+
+        if op_type == 0:
+            args = ()
+        elif op_type == 1:
+            args = (get_reg(operands[0]),)
+        elif op_type == 2:
+            args = (get_reg(operands[0]), get_reg(operands[1]))
         else:
-            result.append(g.upper())
+            try:
+                val = int(operands[1], 0) & 0xff
+            except ValueError:
+                # If it's not a value, it might be a symbol
+                val = operands[1]
+            args = (get_reg(operands[0]), val)
 
-    return result
+        yield (OP, opcode, args, operands, line_num)
 
 
-def p8(v):
-    return "{:08b}".format(v)
 
+def parse(inputfile):
+    """Parse source into the list of items tokenize() yields."""
+    return list(tokenize(inputfile))
 
-def pass1(inputfile, sym, code):
-    """
-    Pass 1
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
-    * Record label offsets
-    * Emit machine code
+def link(items, listing=False):
+    """
+    Lay out items from address 0, resolve label references and return
+    (code, sym, lines) like assemble(). items can be any iterable, such as
+    tokenize() reading a file.
     """
 
-    # Source line number
-    line_num = 0
+    code = bytearray()
+    sym = {}
+    fixups = []     # (offset in code, label)
+
+    # address -> comment for the listing, and address -> labels defined there
+    notes = {} if listing else None
+    label_notes = {} if listing else None
+
+    for item in items:
+        kind = item[0]
+
+        if kind == OP:
+            opcode = item[1]
+            args = item[2]
+            if listing:
+                notes[len(code)] = f"{opcode} {','.join(item[3])}".rstrip()
+            code.append(OPCODE_BYTES[opcode][1])
+            if opcode == "LDI" and args[1].__class__ is str:
+                code.append(args[0])
+                fixups.append((len(code), args[1]))
+                code.append(0)
+            else:
+                code.extend(args)
+
+        elif kind == LABEL:
+            sym[item[1]] = len(code)
+            if listing:
+                label_notes.setdefault(len(code), []).append(item[1])
 
-    # Current code address (for labels)
-    addr = 0
+        else:
+            if listing:
+                for i, note in enumerate(item[2]):
+                    notes[len(code) + i] = '[space]' if note == ' ' else note
+            code += item[1]
 
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
+    # Patch label references now that every address is known
+    for offset, label in fixups:
+        if label not in sym:
+            raise AssemblerError(f"unknown symbol: {label}", 2)
+        code[offset] = sym[label] & 0xff
 
-        nonlocal line_num
+    lines = None
+    if listing:
+        lines = format_listing(code, notes, label_notes)
 
-        m = re.match(r"R([0-7])", op)
+    return code, sym, lines
 
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
-            else:
-                return None
 
-        return int(m.group(1))
+def format_listing(code, notes, label_notes):
+    """
+    The annotated text listing of code: one binary byte per line, with the
+    comment in notes for its address, and a comment line for each label in
+    label_notes defined there.
+    """
+
+    lines = []
+    for addr, byte in enumerate(code):
+        for label in label_notes.get(addr, ()):
+            lines.append(f"# {label} (address {addr}):")
+        if addr in notes:
+            lines.append(f"{byte:08b} # {notes[addr]}")
+        else:
+            lines.append(f"{byte:08b}")
+    for label in label_notes.get(len(code), ()):
+        lines.append(f"# {label} (address {len(code)}):")
+
+    return lines
 
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
 
-        nonlocal addr
+def item_size(item):
+    """Number of bytes an item assembles to."""
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+    if item[0] == OP:
+        return 1 + len(item[2])
+    if item[0] == DATA:
+        return len(item[1])
+    return 0
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
 
-        nonlocal addr
+def is_op(item, opcode, *args):
+    """True if item is the given instruction, with the given leading args."""
+    return (item[0] == OP and item[1] == opcode
+            and item[2][:len(args)] == args)
 
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
+def drop_nops(items, stats):
+    """Remove NOP instructions."""
 
-        nonlocal addr
+    kept = [item for item in items if not is_op(item, "NOP")]
+    stats["nops"] += len(items) - len(kept)
+    return kept
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+def fold_ldi(items, stats):
+    """Fold LDI r,n followed directly by INC r or DEC r into one LDI."""
 
-        addr += 3
+    result = []
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+    for item in items:
+        prev = result[-1] if result else None
+        if (item[0] == OP and item[1] in ("INC", "DEC")
+                and prev is not None and prev[0] == OP and prev[1] == "LDI"
+                and prev[2][0] == item[2][0]
+                and prev[2][1].__class__ is int
+                # LDI into IM or IS takes effect at once, INC and DEC don't
+                and item[2][0] not in (5, 6)):
+            reg = item[2][0]
+            val = (prev[2][1] + (1 if item[1] == "INC" else -1)) & 0xff
+            result[-1] = (OP, "LDI", (reg, val), [f"R{reg}", str(val)],
+                          prev[4])
+            stats["ldi_folds"] += 1
+        else:
+            result.append(item)
 
-        nonlocal addr
+    return result
 
-        reg_a = get_reg(op_a)
 
-        try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+def drop_push_pop(items, stats):
+    """Remove PUSH r directly followed by POP r, which changes nothing."""
 
-        except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+    result = []
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+    for item in items:
+        if (result and item[0] == OP and item[1] == "POP"
+                and is_op(result[-1], "PUSH", item[2][0])):
+            result.pop()
+            stats["push_pops"] += 1
+        else:
+            result.append(item)
 
-        addr += 3
+    return result
 
-    def handle_ds(line):
-        """
-        Handle DS pseudo-opcode
-        """
 
-        nonlocal addr
+def thread_jumps(items, stats):
+    """
+    Retarget LDI r,label; JMP r when label is itself LDI r,other; JMP r, so
+    the jump goes straight to its final destination. Only jumps through the
+    same register are threaded, so registers end up holding the same values.
+    """
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+    # label -> index of the first item after it that isn't a label
+    targets = {}
+    pending = []
+    for i, item in enumerate(items):
+        if item[0] == LABEL:
+            pending.append(item[1])
+        else:
+            for label in pending:
+                targets[label] = i
+            pending = []
+
+    def trampoline(label, reg):
+        """Where a jump to label through reg really ends up, or None."""
+        i = targets.get(label)
+        if (i is not None and i + 1 < len(items)
+                and is_op(items[i], "LDI", reg)
+                and items[i][2][1].__class__ is str
+                and is_op(items[i + 1], "JMP", reg)):
+            return items[i][2][1]
+        return None
+
+    result = list(items)
+
+    for i in range(len(items) - 1):
+        item = items[i]
+        if not (item[0] == OP and item[1] == "LDI"
+                and item[2][1].__class__ is str
+                and is_op(items[i + 1], "JMP", item[2][0])):
+            continue
 
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+        reg, label = item[2]
+        seen = {label}
+        hops = 0
+        dest = trampoline(label, reg)
+        while dest is not None and dest not in seen:
+            seen.add(dest)
+            label = dest
+            hops += 1
+            dest = trampoline(label, reg)
+
+        if hops:
+            result[i] = (OP, "LDI", (reg, label), [f"R{reg}", label],
+                         item[4])
+            stats["jumps_threaded"] += 1
+            # every hop skipped is an LDI and a JMP not executed
+            stats["threaded_hops"] += hops
 
-        data = m.group(2)
+    return result
 
-        for i in range(len(data)):
-            print_char = data[i]
 
-            if print_char == ' ':
-                print_char = '[space]'
+def drop_unreachable(items, stats):
+    """
+    Remove instructions after HLT, JMP, RET or IRET up to the next label.
+    Data is kept, as it is reached by address rather than by falling through.
+    """
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
+    result = []
+    reachable = True
+
+    for item in items:
+        if item[0] == OP:
+            if not reachable:
+                stats["unreachable"] += 1
+                continue
+            if item[1] in NO_FALLTHROUGH:
+                reachable = False
+        else:
+            reachable = True
+        result.append(item)
 
-        addr += len(data)
+    return result
 
-    def handle_db(line):
-        """
-        Handle the DB pseudo-opcode
-        """
 
-        nonlocal addr
+def peephole(items):
+    """
+    Peephole optimizer run between parsing and linking. Applies the passes
+    below until nothing changes and returns the new items and a report of
+    what was done and the bytes and estimated cycles it saved.
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+    Labels are kept and their addresses recomputed by link(), so code that
+    refers to addresses by label keeps working. Numeric addresses in the
+    source are not adjusted.
+    """
 
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+    stats = collections.Counter()
+    size_before = sum(item_size(item) for item in items)
+
+    passes = (drop_nops, fold_ldi, drop_push_pop, thread_jumps,
+              drop_unreachable)
+
+    while True:
+        before = sum(stats.values())
+        for optimization in passes:
+            items = optimization(items, stats)
+        if sum(stats.values()) == before:
+            break
+
+    size_after = sum(item_size(item) for item in items)
+
+    report = {
+        "bytes_before": size_before,
+        "bytes_after": size_after,
+        "bytes_saved": size_before - size_after,
+        "nops": stats["nops"],
+        "ldi_folds": stats["ldi_folds"],
+        "push_pops": stats["push_pops"],
+        "jumps_threaded": stats["jumps_threaded"],
+        "unreachable": stats["unreachable"],
+        # instructions no longer executed each time every changed spot runs
+        # once; unreachable code never ran, so it saves space only
+        "cycles_saved": (stats["nops"] + stats["ldi_folds"]
+                         + 2 * stats["push_pops"]
+                         + 2 * stats["threaded_hops"]),
+    }
 
-        data = m.group(2)
+    return items, report
 
-        try:
-            val = int(data, 0)
 
-        except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+def format_report(report):
+    """One-line summary of a peephole() report."""
 
-        # Force to byte size
-        val &= 0xff
+    return (f"optimized {report['bytes_before']} -> {report['bytes_after']} "
+            f"bytes ({report['bytes_saved']} saved), "
+            f"~{report['cycles_saved']} cycles saved per pass: "
+            f"{report['nops']} NOPs, {report['ldi_folds']} LDI folds, "
+            f"{report['push_pops']} PUSH/POP pairs, "
+            f"{report['jumps_threaded']} jumps threaded, "
+            f"{report['unreachable']} unreachable instructions")
 
-        code.append(f"{p8(val)} # {data}")
 
-        addr += 1
+def assemble(inputfile, listing=False, optimize=False, report=None):
+    """
+    Single-pass assembler that emits machine code straight into a bytearray.
+
+    Lines are tokenized and laid out as they are read. References to labels
+    that aren't known yet are kept in a fixup list and patched once the
+    whole source has been read. Returns (code, sym, lines) where code is the
+    bytearray, sym maps labels to addresses and lines is the annotated text
+    listing, or None unless listing is True. Errors in the source raise
+    AssemblerError.
+
+    With optimize, the whole source is tokenized first and run through
+    peephole() before it is laid out, which is slower but lets instructions
+    move. peephole()'s report is then added to the report dict, if one is
+    given.
+    """
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
+    items = tokenize(inputfile)
+    if optimize:
+        items, stats = peephole(list(items))
+        if report is not None:
+            report.update(stats)
+    return link(items, listing)
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
 
-        # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+def image_module():
+    """
+    Import ls8/image.py, which defines the .ls8b format. It also holds
+    import_sibling(), which the ls8 modules use to import this one; this is
+    the one place that has to find its way there without it.
+    """
 
-        op_type = OPCODES[opcode]["type"]
+    ls8_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "ls8")
+    if ls8_dir not in sys.path:
+        sys.path.insert(0, ls8_dir)
+    import image
 
-        total_operands = 0
+    return image
 
-        if op_a is not None:
-            total_operands += 1
 
-        if op_b is not None:
-            total_operands += 1
+def write_image(outputfile, code, sym):
+    """Write code and symbols as an .ls8b image (see ls8/image.py)."""
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+    outputfile.write(image_module().pack_image(code, sym))
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
 
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
-    }
+def assemble_image(source):
+    """Assemble source text and return it as .ls8b image bytes."""
 
-    for line in inputfile:
-        line_num += 1
+    code, sym, _ = assemble(io.StringIO(source))
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+    return image_module().pack_image(code, sym)
 
-        # Normalize
-        line = line.strip()
 
-        # Ignore blank lines
-        if input == '':
-            continue
+class AssemblyCache:
+    """
+    Assembled images keyed by the SHA-256 of their source text.
 
-        # print(line)  # debug
+    Keeps the most recently used maxsize images in memory. With a cache_dir,
+    images are also stored there as <hash>.ls8b, so other processes and
+    later runs can reuse them.
+    """
 
-        m = re.match(REGEX, line)
+    def __init__(self, maxsize=256, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.images = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
 
-            # print(label, opcode, op_a, op_b)  # debug
+    def assemble(self, source):
+        """Return the .ls8b image for source, assembling it only if needed."""
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+        key = hashlib.sha256(source.encode("utf-8")).hexdigest()
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
+        image = self.images.get(key)
+        if image is not None:
+            self.images.move_to_end(key)
+            self.hits += 1
+            return image
 
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
-        else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+        path = None
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, f"{key}.ls8b")
+            try:
+                with open(path, "rb") as f:
+                    image = f.read()
+                self.hits += 1
+            except FileNotFoundError:
+                pass
 
+        if image is None:
+            self.misses += 1
+            image = assemble_image(source)
 
-def pass2(outputfile, sym, code):
-    """
-    Output the code, substituting in any symbols.
-    """
+            if path is not None:
+                # write then rename, so readers never see a partial file
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(image)
+                os.replace(tmp, path)
 
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
+        self.images[key] = image
+        if len(self.images) > self.maxsize:
+            self.images.popitem(last=False)
 
-            if s in sym:
-                c = p8(sym[s])
+        return image
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
 
-        outputfile.write(f"{c}\n")
+# Cache used when callers don't bring their own
+default_cache = AssemblyCache()
 
 
 def main(argv):
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, optimize = parse_commandline(argv)
 
-    # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
+    # An .ls8b output file gets a binary image instead of the text listing
+    binary = outputfile.endswith(".ls8b")
 
-    # Set up the symbol table
-    sym = {}
+    # Open files
+    if inputfile == "-":
+        inputfile = sys.stdin
+    else:
+        inputfile = open(inputfile)
 
-    # Set up the machine code output
-    code = []
+    if outputfile == "-":
+        outputfile = sys.stdout
+    else:
+        outputfile = open(outputfile, "wb" if binary else "w")
 
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    report = {}
+    try:
+        code, sym, lines = assemble(inputfile, listing=not binary,
+                                    optimize=optimize, report=report)
+    except AssemblerError as e:
+        print(e, file=sys.stderr)
+        return e.status
+    if optimize:
+        print(format_report(report), file=sys.stderr)
+
+    if binary:
+        write_image(outputfile, code, sym)
+    else:
+        outputfile.write("".join(f"{line}\n" for line in lines))
 
     return 0
 
@@ -0,0 +1,173 @@
+"""
+Golden-output checks for the assembler and its peephole optimizer.
+
+Run with pytest from the repository root or from this directory.
+"""
+
+import glob
+import io
+import math
+import os
+
+import pytest
+
+import asm
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCES = sorted(glob.glob(os.path.join(HERE, "*.asm")))
+EXAMPLES = os.path.join(HERE, "..", "ls8", "examples")
+
+image = asm.image_module()
+cpu = image.import_sibling("ls8", "cpu")
+
+# one chance for every peephole pass
+UNOPTIMIZED = """
+LDI R0,Start
+JMP R0
+Start:
+NOP
+LDI R1,5
+INC R1
+PUSH R1
+POP R1
+PRN R1
+LDI R2,Hop
+JMP R2
+PRN R1
+Hop:
+LDI R2,End
+JMP R2
+End:
+HLT
+"""
+
+# UNOPTIMIZED as peephole() should leave it
+OPTIMIZED = """
+LDI R0,Start
+JMP R0
+Start:
+LDI R1,6
+PRN R1
+LDI R2,End
+JMP R2
+Hop:
+LDI R2,End
+JMP R2
+End:
+HLT
+"""
+
+OPTIMIZED_LISTING = """\
+10000010 # LDI R0,START
+00000000
+00000101
+01010100 # JMP R0
+00000000
+# START (address 5):
+10000010 # LDI R1,6
+00000001
+00000110
+01000111 # PRN R1
+00000001
+10000010 # LDI R2,END
+00000010
+00010100
+01010100 # JMP R2
+00000010
+# HOP (address 15):
+10000010 # LDI R2,END
+00000010
+00010100
+01010100 # JMP R2
+00000010
+# END (address 20):
+00000001 # HLT
+"""
+
+
+def assemble(source, **options):
+    return asm.assemble(io.StringIO(source), **options)
+
+
+@pytest.mark.parametrize("source", SOURCES, ids=os.path.basename)
+def test_sources_assemble_to_the_examples(source):
+    with open(source) as f:
+        code, sym, _ = asm.assemble(f)
+
+    name = os.path.basename(source)[:-len(".asm")]
+    program, symbols = image.read_listing(os.path.join(EXAMPLES,
+                                                       f"{name}.ls8"))
+
+    assert bytes(code) == bytes(program)
+    assert sym == symbols
+
+
+@pytest.mark.parametrize("source", SOURCES, ids=os.path.basename)
+def test_image_holds_the_code_and_symbols(source):
+    with open(source) as f:
+        text = f.read()
+    code, sym, _ = assemble(text)
+
+    program, symbols = image.unpack_image(asm.assemble_image(text))
+
+    assert bytes(program) == bytes(code)
+    assert symbols == sym
+
+
+def test_peephole_output():
+    report = {}
+    code, sym, lines = assemble(UNOPTIMIZED, listing=True, optimize=True,
+                                report=report)
+
+    expected_code, expected_sym, _ = assemble(OPTIMIZED)
+    assert code == expected_code
+    assert sym == expected_sym
+    assert "".join(f"{line}\n" for line in lines) == OPTIMIZED_LISTING
+
+    assert report == {
+        "bytes_before": 30, "bytes_after": 21, "bytes_saved": 9,
+        "nops": 1, "ldi_folds": 1, "push_pops": 1, "jumps_threaded": 1,
+        "unreachable": 1, "cycles_saved": 6,
+    }
+
+
+def run(code):
+    """Output and stop reason of code on the emulator, timer stopped."""
+
+    machine = cpu.CPU()
+    machine.ram[:len(code)] = code
+    machine.timer.interval = math.inf
+    machine.timer.set_state(math.inf)
+    output = io.StringIO()
+    machine.set_output(cpu.OutputDevice(output))
+    try:
+        reason = machine.run(max_cycles=10_000)
+    except Exception as e:
+        reason = f"error: {e}"
+    return output.getvalue(), reason
+
+
+@pytest.mark.parametrize("source", SOURCES, ids=os.path.basename)
+def test_peephole_keeps_what_the_examples_do(source):
+    with open(source) as f:
+        text = f.read()
+
+    plain, _, _ = assemble(text)
+    optimized, _, _ = assemble(text, optimize=True)
+
+    assert run(optimized) == run(plain)
+
+
+def test_unknown_opcode():
+    with pytest.raises(asm.AssemblerError, match="Line 2: unknown opcode FOO"):
+        assemble("LDI R0,1\nFOO R0\n")
+
+
+def test_unknown_register():
+    with pytest.raises(asm.AssemblerError, match="unknown register R9"):
+        assemble("LDI R9,1\n")
+
+
+def test_unknown_label():
+    with pytest.raises(asm.AssemblerError, match="unknown symbol: NOWHERE"):
+        assemble("LDI R0,Nowhere\nJMP R0\n")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""Run many LS-8 programs across a process pool, one JSON line per program."""
+
+import argparse
+import concurrent.futures
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+from cpu import *
+
+
+def run_job(path, max_cycles=None, timeout=None):
+    """
+    Load and run a single .ls8 or .ls8b program, capturing its output.
+
+    Returns a dict with the program path, its output, why it stopped
+    ("halted", "max_cycles", "timeout" or "error"), the error message if any,
+    the number of instructions executed and the elapsed wall time.
+    """
+
+    cpu = CPU()
+    output = io.BytesIO()
+    cpu.set_output(OutputDevice(output))
+    error = None
+
+    start = time.perf_counter()
+    try:
+        cpu.load(path)
+
+        reason = cpu.run(max_cycles=max_cycles, timeout=timeout)
+    except Exception as e:
+        reason = "error"
+        error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+
+    return {
+        "program": path,
+        "output": output.getvalue().decode("latin-1"),
+        "exit": reason,
+        "error": error,
+        "cycles": cpu.cycles,
+        "elapsed": elapsed,
+    }
+
+
+def read_manifest(filename):
+    """Read program paths, one per line. Blank lines and # comments are skipped."""
+
+    paths = []
+
+    with open(filename) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line != '':
+                paths.append(line)
+
+    return paths
+
+
+def expand_programs(patterns):
+    """Expand glob patterns into program paths, keeping the given order."""
+
+    paths = []
+
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            print(f"{pattern}: no programs found", file=sys.stderr)
+        paths.extend(matches)
+
+    return paths
+
+
+def run_batch(paths, max_cycles=None, timeout=None, jobs=None, out=sys.stdout):
+    """
+    Run every program in paths on a pool of jobs worker processes (one per
+    core by default), writing one JSON result per line to out in input order.
+    """
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # hand out work in chunks so short programs don't pay a round trip each
+    chunksize = max(1, len(paths) // (jobs * 4))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(run_job, paths,
+                           [max_cycles] * len(paths), [timeout] * len(paths),
+                           chunksize=chunksize)
+        for result in results:
+            out.write(json.dumps(result) + "\n")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run many LS-8 programs and report results as JSON lines.")
+    parser.add_argument("programs", nargs="*",
+                        help=".ls8 or .ls8b files or glob patterns")
+    parser.add_argument("-m", "--manifest",
+                        help="file listing one program path per line")
+    parser.add_argument("--max-cycles", type=int,
+                        help="instruction limit per program")
+    parser.add_argument("--timeout", type=float,
+                        help="wall-time limit per program, in seconds")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="worker processes (default: one per core)")
+    args = parser.parse_args(argv[1:])
+
+    paths = expand_programs(args.programs)
+    if args.manifest:
+        paths.extend(read_manifest(args.manifest))
+
+    if not paths:
+        parser.print_usage(sys.stderr)
+        return 1
+
+    run_batch(paths, args.max_cycles, args.timeout, args.jobs)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
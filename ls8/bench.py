@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite for the LS-8 emulator and assembler.
+
+Usage: bench.py [names...] [--scale N] [--repeat N] [--engine NAME]
+                [--json results.json] [--baseline baseline.json]
+                [--tolerance 0.1]
+
+Each emulator benchmark is generated assembly, run for a fixed number of
+instructions (the programs loop forever, there are no conditional jumps
+yet), and reports instructions per second. The assembler benchmark times
+asm.assemble() on a large generated source and reports lines per second.
+Every benchmark runs in a fresh process, so peak memory is its own.
+
+With --baseline, rates more than --tolerance below the baseline are flagged
+as regressions and the exit status is 1. The baseline must have been
+recorded with the same --engine and --scale.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import platform
+import sys
+import time
+
+import image
+from cpu import *
+from engines import ENGINES, engine_class
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is reported as null
+    resource = None
+
+# instructions each emulator benchmark runs at --scale 1
+CYCLES = 1_000_000
+
+# source lines for the assembler benchmark at --scale 1
+ASM_LINES = 100_000
+
+
+def arith_source():
+    """Long arithmetic loop on the mult.asm pattern."""
+
+    return """
+        LDI R2,Loop
+    Loop:
+        LDI R0,8
+        LDI R1,9
+        MUL R0,R1
+        ADD R0,R1
+        SUB R0,R1
+        AND R0,R1
+        XOR R0,R1
+        INC R3
+        DEC R4
+        JMP R2
+    """
+
+
+def recursion_source(depth=24):
+    """Chains of CALL/RET depth calls deep."""
+
+    lines = ["    LDI R2,Loop",
+             "Loop:",
+             "    LDI R1,Sub0",
+             "    CALL R1",
+             "    JMP R2"]
+    for i in range(depth):
+        lines.append(f"Sub{i}:")
+        if i + 1 < depth:
+            lines.append(f"    LDI R1,Sub{i + 1}")
+            lines.append("    CALL R1")
+        lines.append("    RET")
+
+    return "\n".join(lines) + "\n"
+
+
+def stack_source():
+    """PUSH/POP churn across several registers."""
+
+    return """
+        LDI R2,Loop
+    Loop:
+        PUSH R0
+        PUSH R1
+        PUSH R3
+        PUSH R4
+        POP R4
+        POP R3
+        POP R1
+        POP R0
+        PUSH R2
+        POP R0
+        JMP R2
+    """
+
+
+def interrupts_source():
+    """A storm of software interrupts, each serviced and returned from."""
+
+    return """
+        LDI R0,0xF8
+        LDI R1,Handler
+        ST R0,R1
+        LDI R5,1
+        LDI R0,0
+        LDI R2,Loop
+    Loop:
+        INT R0
+        JMP R2
+    Handler:
+        INC R3
+        IRET
+    """
+
+
+def output_source():
+    """Printing numbers and characters as fast as possible."""
+
+    return """
+        LDI R0,65
+        LDI R1,200
+        LDI R2,Loop
+    Loop:
+        PRA R0
+        PRN R1
+        PRN R0
+        INC R1
+        JMP R2
+    """
+
+
+def asm_source(lines):
+    """A large generated source using labels, data and every operand type."""
+
+    out = []
+    i = 0
+    while len(out) < lines:
+        out.extend([
+            f"L{i}: LDI R{i % 4},L{i}   ; load",
+            "    ADD R0,R1",
+            "    PUSH R2",
+            "    POP R3",
+            f"    DB 0x{i & 0xff:02x}",
+            "    DS Hi there",
+        ])
+        i += 1
+
+    return "\n".join(out[:lines]) + "\n"
+
+
+# name -> function generating the program source
+PROGRAMS = {
+    "arith": arith_source,
+    "recursion": recursion_source,
+    "stack": stack_source,
+    "interrupts": interrupts_source,
+    "output": output_source,
+}
+
+BENCHMARKS = list(PROGRAMS) + ["asm"]
+
+
+def peak_memory_kb():
+    """Peak resident set size of this process, in kilobytes."""
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_benchmark(name, scale=1, repeat=3, engine="cpu"):
+    """Run one benchmark, best of repeat runs. Returns its result dict."""
+
+    asm = image.import_sibling("asm", "asm")
+
+    if name == "asm":
+        lines = int(ASM_LINES * scale)
+        source = asm_source(lines)
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            asm.assemble(io.StringIO(source))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        return {"lines": lines, "seconds": best, "lines_per_sec": lines / best,
+                "peak_kb": peak_memory_kb()}
+
+    code, sym, _ = asm.assemble(io.StringIO(PROGRAMS[name]()))
+    cycles = int(CYCLES * scale)
+    cls = engine_class(engine)
+
+    best = None
+    for _ in range(repeat):
+        cpu = cls()
+        cpu.ram[:len(code)] = code
+        cpu.set_output(OutputDevice(NullWriter()))
+        # emulated time, so the timer doesn't depend on the host's speed
+        cpu.set_clock(1_000_000, throttle=False)
+
+        start = time.perf_counter()
+        cpu.run(max_cycles=cycles)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {"instructions": cpu.cycles, "seconds": best,
+            "instructions_per_sec": cpu.cycles / best,
+            "peak_kb": peak_memory_kb()}
+
+
+def rate(result):
+    """The number a benchmark is judged by: higher is better."""
+    return result.get("instructions_per_sec", result.get("lines_per_sec"))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the names of benchmarks whose rate dropped by more than
+    tolerance (a fraction) against the baseline results.
+    """
+
+    regressions = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if rate(result) < rate(base) * (1 - tolerance):
+            regressions.append(name)
+
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the LS-8 emulator and assembler.")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help=f"benchmarks to run: {', '.join(BENCHMARKS)} "
+                             "(default: all)")
+    parser.add_argument("--scale", type=float, default=1,
+                        help="multiply the work each benchmark does")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per benchmark, the fastest is kept")
+    parser.add_argument("--engine", choices=list(ENGINES), default="cpu",
+                        help="execution engine (default cpu)")
+    parser.add_argument("--json", help="write the results here")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown against the baseline that counts as "
+                             "a regression (default 0.1)")
+    args = parser.parse_args(argv[1:])
+
+    names = args.names or BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            recorded = json.load(f)
+        # rates from another engine or scale aren't comparable
+        mismatched = [f"--{key} {recorded.get(key)}"
+                      for key in ("engine", "scale")
+                      if recorded.get(key) != getattr(args, key)]
+        if mismatched:
+            parser.error(f"{args.baseline} was recorded with "
+                         f"{' and '.join(mismatched)}, run with the same "
+                         "settings to compare")
+        baseline = recorded["results"]
+
+    results = {}
+    # a fresh process per benchmark keeps the peak memory figures separate
+    context = multiprocessing.get_context("spawn")
+
+    for name in names:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_benchmark,
+                                (name, args.scale, args.repeat, args.engine))
+        results[name] = result
+
+        line = f"{name:12s}"
+        if "instructions_per_sec" in result:
+            line += f"{result['instructions_per_sec']:14,.0f} instr/s"
+        else:
+            line += f"{result['lines_per_sec']:14,.0f} lines/s"
+        if result["peak_kb"] is not None:
+            line += f"{result['peak_kb']:10,d} KB peak"
+        if name in baseline:
+            change = rate(result) / rate(baseline[name]) - 1
+            line += f"  {change:+.1%} vs baseline"
+        print(line)
+
+    regressions = compare(results, baseline, args.tolerance)
+    for name in regressions:
+        print(f"REGRESSION: {name} is more than {args.tolerance:.0%} slower "
+              "than the baseline", file=sys.stderr)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "engine": args.engine,
+                "scale": args.scale,
+                "results": results,
+            }, f, indent=2)
+            f.write("\n")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,7 +1,17 @@
 """CPU functionality."""
 
+import io
+import os
 import sys
-import datetime
+import math
+import mmap
+import struct
+import time
+import functools
+import threading
+import collections
+
+import image
 
 # register psuedonyms
 IM = 5  # interrupt mask
@@ -46,13 +56,376 @@ instr = {
     0b10101011: "XOR"
 }
 
+# ALU instruction names mapped back to their opcodes
+alu_ops = {name: ir for ir, name in instr.items() if ir >> 5 & 0b001}
+
+# number of instructions executed between polls of the timer and devices
+POLL_INTERVAL = 1024
+
+# seconds output may sit in the OutputDevice buffer before a poll writes it
+FLUSH_INTERVAL = 0.1
+
+# longest idle loop, in instructions, that the CPU fast-forwards through
+IDLE_LOOP_MAX = 8
+
+# instructions per second the host is taken to run until the CPU has timed
+# itself, see CPU.measure_speed()
+DEFAULT_SPEED = 1_000_000
+
+# Flat layout of a saved CPU state: registers, RAM, PC, FL, interrupts
+# enabled, cycle count and the time left until the next timer interrupt.
+STATE = struct.Struct("<8s256sHBBQd")
+
+# Checkpoint files are a magic number and version followed by a STATE
+CHECKPOINT_MAGIC = b"LS8C"
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = struct.Struct("<4sH")
+
+
+def read_program(filename):
+    """Read an .ls8 file and return the program as a list of 256 bytes."""
+
+    program, _ = image.read_listing(filename)
+
+    return list(program) + [0] * (256 - len(program))
+
+
+class Halted(Exception):
+    """Raised by the HLT instruction to stop the run loop."""
+
+
+class InterruptController:
+    """
+    Keeps a cached mask of the interrupts waiting to be serviced.
+
+    The mask is IM & IS while interrupts are enabled and 0 otherwise. It is
+    only recomputed when something changes it: INT, IRET, servicing an
+    interrupt, a load into IM or IS, or an external source raising an
+    interrupt. The run loop only has to test `pending` before each
+    instruction.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.pending = 0
+
+    def update(self):
+        """Recompute the pending mask from IM, IS and the enable flag."""
+
+        cpu = self.cpu
+        if cpu.interrupts_enabled:
+            self.pending = cpu.reg[IM] & cpu.reg[IS]
+        else:
+            self.pending = 0
+
+    def raise_interrupt(self, num):
+        """Set the bit for the given interrupt in IS."""
+
+        self.cpu.reg[IS] = self.cpu.reg[IS] | (0b1 << num)
+        self.update()
+
+
+class Clock:
+    """
+    The CPU's notion of time and how fast it runs.
+
+    With no rate the CPU runs flat out and time is the monotonic wall clock.
+    With a rate in instructions per second, time is emulated: cycles / rate
+    seconds have passed after `cycles` instructions, so the timer fires
+    after the same number of instructions however fast the host is. If
+    throttle is also set, poll() sleeps whenever the CPU gets ahead of the
+    target rate. That happens once per POLL_INTERVAL instructions rather
+    than per instruction, so pacing costs next to nothing.
+    """
+
+    # fall further behind than this (paused, or a slow host) and pacing
+    # starts over rather than running flat out to catch up
+    MAX_LAG = 0.1
+
+    def __init__(self, cpu, rate=None, throttle=True):
+        self.cpu = cpu
+        self.rate = rate
+        self.throttle = throttle
+        # wall time and cycle count pacing is measured from
+        self.base_time = None
+        self.base_cycles = 0
+
+    def time(self):
+        """Seconds on the CPU's clock."""
+
+        if self.rate is None:
+            return time.monotonic()
+        return self.cpu.cycles / self.rate
+
+    def poll(self, cpu):
+        if self.rate is None or not self.throttle:
+            return
+
+        now = time.monotonic()
+        if self.base_time is None:
+            self.base_time = now
+            self.base_cycles = cpu.cycles
+            return
+
+        ahead = self.wall_time(cpu.cycles) - now
+        if ahead > 0:
+            time.sleep(ahead)
+        elif ahead < -self.MAX_LAG:
+            self.base_time = now
+            self.base_cycles = cpu.cycles
+
+    def wall_time(self, cycles):
+        """When a throttled CPU is paced to reach the cycle count."""
+        return self.base_time + (cycles - self.base_cycles) / self.rate
+
+    def cycles_at(self, wall_time):
+        """The cycle count a throttled CPU is paced to reach by wall_time."""
+        return self.base_cycles + int((wall_time - self.base_time) * self.rate)
+
+
+class Timer:
+    """
+    Issues the timer interrupt (I0) once every `interval` seconds.
+
+    The deadline is kept on `clock` (see Clock), the monotonic wall clock by
+    default, and is only checked when the CPU polls its devices, every
+    POLL_INTERVAL instructions.
+    """
+
+    def __init__(self, interval=1.0, clock=None):
+        self.interval = interval
+        self.clock = clock
+        self.deadline = self.time() + interval
+
+    def time(self):
+        if self.clock is None:
+            return time.monotonic()
+        return self.clock.time()
+
+    def poll(self, cpu):
+        now = self.time()
+        if now >= self.deadline:
+            cpu.interrupts.raise_interrupt(0)
+            self.deadline = now + self.interval
+
+    def due(self, cpu):
+        """On an emulated clock, the cycle count the timer fires at."""
+
+        if (self.clock is None or self.clock.rate is None
+                or self.deadline == math.inf):
+            return math.inf
+        return max(math.ceil(self.deadline * self.clock.rate), cpu.cycles + 1)
+
+    def wake_time(self, cpu):
+        """
+        On the wall clock, when the timer next interrupts an idle CPU (see
+        CPU.fast_forward()).
+        """
+
+        if not cpu.reg[IM] & 0b00000001:
+            return math.inf
+        if self.clock is None or self.clock.rate is None:
+            return self.deadline
+        return math.inf
+
+    def get_state(self):
+        """Seconds left until the timer fires."""
+        return self.deadline - self.time()
+
+    def set_state(self, remaining):
+        self.deadline = self.time() + remaining
+
+
+class Keyboard:
+    """
+    Issues the keyboard interrupt (I1) for bytes read from a stream.
+
+    A background thread reads the stream (stdin by default, or a pipe, file
+    or any other binary or text stream) and queues the bytes. The CPU picks
+    them up one at a time when it polls its devices: the key is written to
+    KEY_ADDR (0xF4) and bit 1 of IS is set. The run loop itself never
+    reads or waits on the stream.
+
+    The next key is held back until the previous one has been serviced, so
+    scripted input can be fed as fast as it can be read without losing
+    keys. IRET hands over the next queued key straight away, so a burst of
+    input doesn't wait a poll interval per key. When the stream is a
+    terminal it is put into cbreak mode, so keys arrive without waiting for
+    Enter; close() restores it.
+    """
+
+    KEY_ADDR = 0xF4
+
+    def __init__(self, stream=None):
+        if stream is None:
+            stream = sys.stdin
+
+        # read bytes rather than characters where there is a choice
+        self.stream = getattr(stream, "buffer", stream)
+        self.keys = collections.deque()     # appends and pops are atomic
+        self.eof = False
+        # set whenever keys arrive or the stream ends, see wait()
+        self.ready = threading.Event()
+        self.saved_tty = None
+
+        try:
+            if self.stream.isatty():
+                import termios
+                import tty
+
+                fd = self.stream.fileno()
+                self.saved_tty = termios.tcgetattr(fd)
+                tty.setcbreak(fd)
+        except (AttributeError, ValueError, ImportError, OSError):
+            pass
+
+        self.thread = threading.Thread(target=self.read_keys, daemon=True)
+        self.thread.start()
+
+    def read_keys(self):
+        """Reader thread: queue every byte from the stream until EOF."""
+
+        try:
+            # read the file descriptor directly where there is one: a thread
+            # blocked inside a buffered stream holds its lock, which makes
+            # interpreter shutdown abort
+            fd = self.stream.fileno()
+            read = functools.partial(os.read, fd)
+        except (AttributeError, ValueError, OSError):
+            read = getattr(self.stream, "read1", self.stream.read)
+
+        try:
+            while True:
+                data = read(4096)
+                if not data:
+                    break
+                if isinstance(data, str):
+                    data = data.encode("latin-1")
+                self.keys.extend(data)
+                self.ready.set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.eof = True
+            self.ready.set()
+
+    def done(self):
+        """True once the stream has ended and every key has been delivered."""
+        return self.eof and not self.keys
+
+    def listening(self, cpu):
+        """True if a key still to come would interrupt an idle CPU."""
+        return bool(cpu.reg[IM] & 0b00000010) and not self.done()
+
+    def wait(self, timeout=None):
+        """
+        Block until a key arrives or the stream ends, for at most timeout
+        seconds.
+        """
+
+        self.ready.clear()
+        if self.keys or self.eof:
+            return
+        self.ready.wait(timeout)
+
+    def poll(self, cpu):
+        # deliver outside interrupt handlers, once the last key was serviced
+        if (self.keys and cpu.interrupts_enabled
+                and not cpu.reg[IS] & 0b00000010):
+            cpu.ram_write(self.keys.popleft(), self.KEY_ADDR)
+            cpu.interrupts.raise_interrupt(1)
+
+    def close(self):
+        """Give a terminal its original settings back."""
+
+        if self.saved_tty is not None:
+            import termios
+
+            termios.tcsetattr(self.stream.fileno(), termios.TCSADRAIN,
+                              self.saved_tty)
+            self.saved_tty = None
+
+
+class NullWriter:
+    """Writer that throws everything away, for benchmarking."""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class OutputDevice:
+    """
+    Buffered console output for PRN and PRA.
+
+    Output bytes are collected in one buffer, so characters and numbers stay
+    in the order they were printed. The buffer is written out once
+    `threshold` bytes are waiting, whenever run() returns, before the CPU
+    waits in an idle loop and at the first poll `interval` seconds after
+    the last write, so a program that never halts loses at most that much
+    output when it is killed. When the writer is a terminal it is flushed
+    at every poll, so interactive programs still show output promptly.
+
+    writer can be a text stream (sys.stdout, io.StringIO), a binary stream
+    (a file opened with "wb", io.BytesIO) or a NullWriter.
+    """
+
+    def __init__(self, writer=None, threshold=4096, interval=FLUSH_INTERVAL):
+        if writer is None:
+            writer = sys.stdout
+
+        self.writer = writer
+        self.threshold = threshold
+        self.interval = interval
+        self.buffer = bytearray()
+        self.flushed = time.monotonic()
+
+        # bytes 0-255 map one to one onto latin-1 characters
+        self.text = isinstance(writer, io.TextIOBase)
+        try:
+            self.interactive = writer.isatty()
+        except (AttributeError, ValueError):
+            self.interactive = False
+
+    def write_char(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.threshold:
+            self.flush()
+
+    def write_int(self, value):
+        self.buffer += b"%d\n" % value
+        if len(self.buffer) >= self.threshold:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        # taken out first, so a flush cut short by a signal doesn't repeat it
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        self.flushed = time.monotonic()
+        if self.text:
+            self.writer.write(data.decode("latin-1"))
+        else:
+            self.writer.write(data)
+        self.writer.flush()
+
+    def poll(self, cpu):
+        if self.buffer and (self.interactive or time.monotonic() - self.flushed
+                            >= self.interval):
+            self.flush()
+
 
 class CPU:
     """Main CPU class."""
 
     def __init__(self):
         """Construct a new CPU."""
-        self.reg = [0] * 8
+        # registers and RAM hold bytes, so values are always 0-255
+        self.reg = bytearray(8)
         # R5 is reserved as the interrupt mask (IM)
         self.reg[IM] = 0b00000001
         # R6 is reserved as the interrupt status (IS)
@@ -61,11 +434,39 @@ class CPU:
         # Program Counter - location of currently executing instruction in RAM
         self.pc = 0
         self.fl = 0             # flags - holds results of CMP instruction
-        self.ram = [0] * 256
+        self.ram = bytearray(256)
+        # label name -> address, when the loaded program has them
+        self.symbols = {}
 
         self.interrupts_enabled = True
-
-        self.clock_tick = datetime.datetime.now().second
+        self.interrupts = InterruptController(self)
+
+        # number of instructions executed so far
+        self.cycles = 0
+        # sources of external interrupts, polled every POLL_INTERVAL cycles
+        self.clock = Clock(self)
+        self.timer = Timer(clock=self.clock)
+        self.output = OutputDevice()
+        self.devices = [self.timer, self.output, self.clock]
+        # no keyboard until attach_keyboard(), so stdin is left alone
+        self.keyboard = None
+        # fast-forward through idle loops instead of executing them, see
+        # fast_forward()
+        self.skip_idle = True
+        # instructions per second the host runs: the instructions and
+        # seconds measured so far and the (time, cycles) to measure from next
+        self.speed = DEFAULT_SPEED
+        self.measured = [0, 0.0]
+        self.speed_base = None
+
+        # limits for the current run(), checked when devices are polled
+        self.cycle_limit = math.inf
+        self.time_limit = None
+        # cycle count the run loop polls at next at the latest, see schedule()
+        self.poll_limit = math.inf
+
+        # opcode -> (handler, number of operands, sets PC), see build_dispatch
+        self.dispatch = self.build_dispatch()
 
     def ram_read(self, addr):
         if addr < len(self.ram):
@@ -79,95 +480,217 @@ class CPU:
         else:
             raise Exception("Memory address out of range!")
 
-    def load(self):
-        """Load a program into memory."""
+    def reg_view(self):
+        """Read-only view of the registers, for inspection without copying."""
+        return memoryview(self.reg).toreadonly()
 
-        address = 0
-        load_address = 0
+    def ram_view(self):
+        """Read-only view of RAM, for inspection without copying."""
+        return memoryview(self.ram).toreadonly()
 
-        program = [0] * 256
+    def set_output(self, output):
+        """
+        Send PRN/PRA output to a different OutputDevice. Anything still
+        buffered in the current one is flushed first.
+        """
 
-        if len(sys.argv) != 2:
-            print(f"Usage:\npython3 {sys.argv[0]} filename.ls8")
-            exit()
-        try:
-            with open(sys.argv[1]) as f:
-                for line in f:
-                    possible_num = line[:line.find('#')]    # strip comments
-                    if possible_num == '':                  # strip blank lines
-                        continue
-                    # convert "binary" string into a number
-                    program[load_address] = (int(possible_num, 2))
-                    load_address += 1
-                    if load_address == 256:
-                        raise Exception("Out of memory. Program is too large.")
-
-        except FileNotFoundError:
-            print(f"{sys.argv[1]} not found.")
-            exit()
-
-        for instruction in program:
-            self.ram[address] = instruction
-            address += 1
+        self.output.flush()
+        self.devices[self.devices.index(self.output)] = output
+        self.output = output
+
+    def set_clock(self, rate=None, throttle=True):
+        """
+        Run at rate instructions per second, or flat out when rate is None.
+        With a rate, the timer counts emulated time, and throttle=False runs
+        as fast as possible while still firing the timer every rate
+        instructions per second of interval.
+        """
+
+        remaining = self.timer.get_state()
+        self.clock.rate = rate
+        self.clock.throttle = throttle
+        self.clock.base_time = None
+        # the time left on the timer carries over to the new clock
+        self.timer.set_state(remaining)
+
+    def attach_keyboard(self, keyboard=None):
+        """
+        Start taking keyboard interrupts from a Keyboard device, by default
+        one reading stdin. Returns the device.
+        """
+
+        if keyboard is None:
+            keyboard = Keyboard()
+        self.keyboard = keyboard
+        self.devices.append(keyboard)
+
+        return keyboard
+
+    def snapshot(self):
+        """
+        Save the machine state at the current instruction boundary as a flat
+        bytes object that restore() accepts.
+        """
+
+        return STATE.pack(self.reg, self.ram, self.pc, self.fl,
+                          self.interrupts_enabled, self.cycles,
+                          self.timer.get_state())
+
+    def restore(self, state, offset=0):
+        """
+        Restore a state saved by snapshot(). state can be any buffer, such as
+        bytes or an mmap, with the state starting at offset.
+        """
+
+        (reg, ram, self.pc, self.fl, interrupts_enabled, self.cycles,
+         timer) = STATE.unpack_from(state, offset)
+
+        # copy in place, the dispatch table and engines hold on to these
+        self.reg[:] = reg
+        self.ram[:] = ram
+        self.interrupts_enabled = bool(interrupts_enabled)
+        self.timer.set_state(timer)
+        self.interrupts.update()
+
+    def fork(self):
+        """
+        Return a new CPU of the same type that carries on from this one's
+        state independently.
+
+        The child is built by the class's constructor, so it has its own
+        dispatch table, devices and engine caches, and the machine state is
+        copied straight across, one copy per buffer. It keeps the symbols,
+        clock setting, timer, skip_idle and speed estimate, and writes to
+        the same output writer through a buffer of its own. A keyboard or
+        other device added after construction is not carried over, since it
+        can't be shared. Engines carry over their own settings by extending
+        fork().
+        """
+
+        # the child's output goes after everything printed so far
+        self.output.flush()
+
+        child = type(self)()
+        child.reg[:] = self.reg
+        child.ram[:] = self.ram
+        child.pc = self.pc
+        child.fl = self.fl
+        child.interrupts_enabled = self.interrupts_enabled
+        child.cycles = self.cycles
+        child.symbols = dict(self.symbols)
+        child.interrupts.update()
+
+        child.set_clock(self.clock.rate, self.clock.throttle)
+        child.timer.interval = self.timer.interval
+        child.timer.set_state(self.timer.get_state())
+        output = self.output
+        child.set_output(OutputDevice(output.writer, output.threshold,
+                                      output.interval))
+        child.skip_idle = self.skip_idle
+        child.speed = self.speed
+        child.measured = list(self.measured)
+        return child
+
+    def save_checkpoint(self, filename):
+        """Write the current state to a checkpoint file."""
+
+        with open(filename, "wb") as f:
+            f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION))
+            f.write(self.snapshot())
+
+    def load_checkpoint(self, filename):
+        """Resume from a checkpoint file written by save_checkpoint()."""
+
+        with open(filename, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                if len(m) < CHECKPOINT_HEADER.size + STATE.size:
+                    raise Exception(f"{filename}: checkpoint is truncated")
+
+                magic, version = CHECKPOINT_HEADER.unpack_from(m)
+                if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+                    raise Exception(f"{filename}: not an LS-8 checkpoint")
+
+                self.restore(m, CHECKPOINT_HEADER.size)
+
+    def load(self, filename=None):
+        """
+        Load a program into memory, either an .ls8 text file or an .ls8b
+        image. Without a filename, the one given on the command line is used.
+        """
+
+        if filename is None:
+            if len(sys.argv) != 2:
+                print(f"Usage:\npython3 {sys.argv[0]} filename.ls8")
+                exit()
+            try:
+                self.load(sys.argv[1])
+            except FileNotFoundError:
+                print(f"{sys.argv[1]} not found.")
+                exit()
+            return
+
+        if filename.endswith(".ls8b"):
+            self.load_image(filename)
+        else:
+            program, self.symbols = image.read_listing(filename)
+            self.ram[:] = program + bytes(len(self.ram) - len(program))
+
+    def load_image(self, source):
+        """
+        Load an .ls8b image from a filename (memory-mapped) or from bytes or
+        any other buffer.
+        """
+
+        self.symbols = image.load_image(self.ram, source)
+
+    def load_asm(self, source, cache=None):
+        """
+        Assemble LS-8 assembly source text in-process and load the result.
+        Images are cached by source (see asm.AssemblyCache), so loading the
+        same source again skips the assembler.
+        """
+
+        asm = image.import_sibling("asm", "asm")
+        if cache is None:
+            cache = asm.default_cache
+        self.load_image(cache.assemble(source))
 
     def alu(self, op, reg_a, reg_b):
         """ALU operations."""
 
-        if op == "ADD":
-            self.reg[reg_a] += self.reg[reg_b]
-        elif op == "AND":
-            self.reg[reg_a] = self.reg[reg_a] & self.reg[reg_b]
-        elif op == "CMP":
-            """
-            The flags register FL holds the current flags status. These flags can change based on the
-            operands given to the CMP opcode.
-            The register is made up of 8 bits. If a particular bit is set, that flag is "true".
-
-            FL bits: 00000LGE
-
-            L Less-than: during a CMP, set to 1 if registerA is less than registerB, zero otherwise.
-            G Greater-than: during a CMP, set to 1 if registerA is greater than registerB, zero otherwise.
-            E Equal: during a CMP, set to 1 if registerA is equal to registerB, zero otherwise.
-            """
-
-            if self.reg[reg_a] == self.reg[reg_b]:
-                self.fl = 1
-            elif self.reg[reg_a] > self.reg[reg_b]:
-                self.fl = 2
-            elif self.reg[reg_a] < self.reg[reg_b]:
-                self.fl = 4
-            else:
-                raise Exception(
-                    "CMP: Invalid inputs or error computing result")
-        elif op == "DEC":
-            self.reg[reg_a] -= 1
-        elif op == "DIV":
-            if self.reg[reg_b]:
-                raise Exception("DIV: Division by zero")
-            self.reg[reg_a] /= self.reg[reg_b]
-        elif op == "INC":
-            self.reg[reg_a] += 1
-        elif op == "MOD":
-            if self.reg[reg_b]:
-                raise Exception("MOD: Division by zero")
-            self.reg[reg_a] = self.reg[reg_a] % self.reg[reg_b]
-        elif op == "MUL":
-            self.reg[reg_a] *= self.reg[reg_b]
-        elif op == "NOT":
-            self.reg[reg_a] = ~self.reg[reg_a]
-        elif op == "OR":
-            self.reg[reg_a] = self.reg[reg_a] | self.reg[reg_b]
-        elif op == "SHL":
-            self.reg[reg_a] = self.reg[reg_a] << self.reg[reg_b]
-        elif op == "SHR":
-            self.reg[reg_a] = self.reg[reg_a] >> self.reg[reg_b]
-        elif op == "SUB":
-            self.reg[reg_a] -= self.reg[reg_b]
-        elif op == "XOR":
-            self.reg[reg_a] = self.reg[reg_a] ^ self.reg[reg_b]
-        else:
+        if op not in alu_ops:
             raise Exception("Unsupported ALU operation")
 
+        if alu_ops[op] >> 6 == 1:
+            # single operand ALU instructions (DEC, INC, NOT)
+            getattr(self, op)(reg_a)
+        else:
+            getattr(self, op)(reg_a, reg_b)
+
+    def build_dispatch(self):
+        """
+        Resolve every possible opcode to its handler once, up front.
+
+        Returns a 256-entry list indexed by the instruction byte. Each entry is
+        a tuple of (bound handler, number of operands, sets PC). Bytes that are
+        not valid instructions map to a handler that raises when executed.
+        """
+
+        dispatch = []
+
+        for ir in range(256):
+            if ir in instr:
+                dispatch.append(
+                    (getattr(self, instr[ir]), ir >> 6, bool(ir >> 4 & 0b0001)))
+            else:
+                dispatch.append(
+                    (functools.partial(self.invalid_instruction, ir), 0, False))
+
+        return dispatch
+
+    def invalid_instruction(self, ir):
+        raise Exception(f"Invlaid instruction {ir}. Terminating.")
+
     def trace(self):
         """
         Handy function to print out the CPU state. You might want to call this
@@ -188,62 +711,226 @@ class CPU:
 
         print()
 
-    def run(self):
-        """Run the CPU."""
-
-        running = True
-        while running:
-            if self.interrupts_enabled:
-                if datetime.datetime.now().second - self.clock_tick >= 1:
-                    self.clock_tick = datetime.datetime.now().second
-                    # issue the time interrupt
-                    self.reg[IS] = self.reg[IS] | 0b00000001
-
-            self.check_interrupts()
-
-            """
-            Meanings of the bits in the first byte of each instruction: AABCDDDD
-
-            AA Number of operands for this opcode, 0-2
-            B 1 if this is an ALU operation
-            C 1 if this instruction sets the PC
-            DDDD Instruction identifier
-            """
-
-            # read the byte at the program counter into the Instruction Register
-            ir = self.ram_read(self.pc)
-            # read the next two bytes in case the instruction needs to utilize them
-            num_operands = ir >> 6
-            operand_a = self.ram_read(self.pc + 1)
-            operand_b = self.ram_read(self.pc + 2)
-
-            if ir not in instr:
-                raise Exception(f"Invlaid instruction {ir}. Terminating.")
-
-            # Direct the CPU to follow the correct instruction
-            if instr[ir] == "HLT":
-                # HLT "halt" instruction, ends program
-                exit()
-            elif (ir >> 5) & 0b001:
-                # this is an ALU instruction - transfer to ALU
-                self.alu(instr[ir], operand_a, operand_b)
-            elif num_operands == 0:
-                # single byte instructions (no operands)
-                getattr(self, instr[ir])()
-            elif num_operands == 1:
-                # two-bye (one operand) instructions
-                getattr(self, instr[ir])(operand_a)
-            elif num_operands == 2:
-                # three-byte (two operand) instructions
-                getattr(self, instr[ir])(operand_a, operand_b)
-
-            # Move the Program Counter
-            if ir >> 4 & 0b0001:
-                # this instruction set the PC, so we won't move it.
-                continue
+    def set_limits(self, max_cycles=None, timeout=None):
+        """
+        Limit the next run to max_cycles more instructions and timeout more
+        seconds. None means no limit.
+        """
+
+        if max_cycles is None:
+            self.cycle_limit = math.inf
+        else:
+            self.cycle_limit = self.cycles + max_cycles
+
+        if timeout is None:
+            self.time_limit = None
+        else:
+            self.time_limit = time.monotonic() + timeout
+
+        # time between runs isn't time spent running
+        self.speed_base = (time.monotonic(), self.cycles)
+
+        self.schedule()
+
+    def schedule(self):
+        """
+        Work out poll_limit: the run's cycle limit, or sooner if a device has
+        an event due at a known cycle count. Devices that do have a `due(cpu)`
+        method returning that count (or math.inf), so the run loop polls them
+        at exactly the right instruction rather than up to POLL_INTERVAL
+        later.
+        """
+
+        limit = self.cycle_limit
+        for device in self.devices:
+            due = getattr(device, "due", None)
+            if due is not None:
+                limit = min(limit, due(self))
+        self.poll_limit = limit
+
+    # Every engine's run() is built from the helpers below: start_run(),
+    # then a loop that calls poll_point() when the cycle count reaches
+    # next_poll and interrupt_point() when an interrupt is pending before
+    # fetching and executing at pc, and end_run() on the way out, also when
+    # an instruction raises. An engine only supplies the fetch and execute
+    # step, most of them through execute().
+
+    def start_run(self, max_cycles=None, timeout=None):
+        """
+        Set the limits for a run (see set_limits()) and return the PC, the
+        cycle count and the cycle count to poll at first.
+        """
+
+        self.set_limits(max_cycles, timeout)
+        return self.pc, self.cycles, min(self.cycles + POLL_INTERVAL,
+                                         self.poll_limit)
+
+    def poll_point(self, pc, cycles):
+        """
+        Poll the devices with the run loop's PC and cycle count (see poll()).
+        Returns the reason to stop or None, the cycle count, which
+        fast-forwarding through an idle loop moves, and the cycle count to
+        poll at next.
+        """
+
+        self.pc = pc
+        self.cycles = cycles
+        stopped = self.poll()
+        return stopped, self.cycles, min(self.cycles + POLL_INTERVAL,
+                                         self.poll_limit)
+
+    def interrupt_point(self, pc):
+        """Service the pending interrupt at pc and return the new PC."""
+
+        self.pc = pc
+        self.check_interrupts()
+        return self.pc
+
+    def end_run(self, pc, cycles):
+        """Store the run loop's PC and cycle count and flush the output."""
+
+        self.pc = pc
+        self.cycles = cycles
+        self.output.flush()
+
+    def execute(self, pc):
+        """Execute the instruction at pc and return the next PC."""
+
+        ram = self.ram
+        handler, num_operands, sets_pc = self.dispatch[ram[pc]]
+
+        if sets_pc:
+            # PC-setting handlers read and write self.pc
+            self.pc = pc
+            if num_operands == 0:
+                handler()
             else:
-                # move the PC forward by one + the number of operands used
-                self.pc += num_operands + 1
+                handler(ram[pc + 1])
+            return self.pc
+        if num_operands == 0:
+            handler()
+            return pc + 1
+        if num_operands == 1:
+            handler(ram[pc + 1])
+            return pc + 2
+        handler(ram[pc + 1], ram[pc + 2])
+        return pc + 3
+
+    def run(self, max_cycles=None, timeout=None):
+        """
+        Run the CPU until it halts or hits a limit.
+
+        max_cycles caps the number of instructions and timeout the seconds this
+        call may take. Returns why the CPU stopped: "halted", "max_cycles" or
+        "timeout".
+        """
+
+        pc, cycles, next_poll = self.start_run(max_cycles, timeout)
+
+        ram = self.ram
+        dispatch = self.dispatch
+        interrupts = self.interrupts
+
+        try:
+            while True:
+                if cycles >= next_poll:
+                    stopped, cycles, next_poll = self.poll_point(pc, cycles)
+                    if stopped:
+                        return stopped
+
+                if interrupts.pending:
+                    pc = self.interrupt_point(pc)
+
+                # execute() inlined, a call per instruction would cost this,
+                # the fastest loop, around a third of its speed
+                handler, num_operands, sets_pc = dispatch[ram[pc]]
+                cycles += 1
+
+                if sets_pc:
+                    # PC-setting handlers read and write self.pc
+                    self.pc = pc
+                    if num_operands == 0:
+                        handler()
+                    else:
+                        handler(ram[pc + 1])
+                    pc = self.pc
+                elif num_operands == 0:
+                    handler()
+                    pc += 1
+                elif num_operands == 1:
+                    handler(ram[pc + 1])
+                    pc += 2
+                else:
+                    handler(ram[pc + 1], ram[pc + 2])
+                    pc += 3
+        except Halted:
+            return "halted"
+        finally:
+            # also keep the state accurate when an instruction raises
+            self.end_run(pc, cycles)
+
+    def run_reference(self, max_cycles=None, timeout=None):
+        """
+        Run the CPU using the original string-based dispatch. Kept as a
+        reference for checking the behaviour of run().
+        """
+
+        self.set_limits(max_cycles, timeout)
+
+        try:
+            running = True
+            while running:
+                stopped = self.poll()
+                if stopped:
+                    return stopped
+                self.check_interrupts()
+
+                """
+                Meanings of the bits in the first byte of each instruction: AABCDDDD
+
+                AA Number of operands for this opcode, 0-2
+                B 1 if this is an ALU operation
+                C 1 if this instruction sets the PC
+                DDDD Instruction identifier
+                """
+
+                # read the byte at the program counter into the Instruction Register
+                ir = self.ram_read(self.pc)
+                self.cycles += 1
+                # read the next two bytes in case the instruction needs to utilize them
+                num_operands = ir >> 6
+                operand_a = self.ram_read(self.pc + 1)
+                operand_b = self.ram_read(self.pc + 2)
+
+                if ir not in instr:
+                    raise Exception(f"Invlaid instruction {ir}. Terminating.")
+
+                # Direct the CPU to follow the correct instruction
+                if instr[ir] == "HLT":
+                    # HLT "halt" instruction, ends program
+                    return "halted"
+                elif (ir >> 5) & 0b001:
+                    # this is an ALU instruction - transfer to ALU
+                    self.alu(instr[ir], operand_a, operand_b)
+                elif num_operands == 0:
+                    # single byte instructions (no operands)
+                    getattr(self, instr[ir])()
+                elif num_operands == 1:
+                    # two-bye (one operand) instructions
+                    getattr(self, instr[ir])(operand_a)
+                elif num_operands == 2:
+                    # three-byte (two operand) instructions
+                    getattr(self, instr[ir])(operand_a, operand_b)
+
+                # Move the Program Counter
+                if ir >> 4 & 0b0001:
+                    # this instruction set the PC, so we won't move it.
+                    continue
+                else:
+                    # move the PC forward by one + the number of operands used
+                    self.pc += num_operands + 1
+        finally:
+            self.output.flush()
 
     def check_interrupts(self):
         """
@@ -270,33 +957,274 @@ class CPU:
         7. Set the PC is set to the handler address.
         """
 
+        if not self.interrupts_enabled:
+            return
+
         maskedInterrupts = self.reg[IM] & self.reg[IS]
+        if not maskedInterrupts:
+            return
+
+        # lowest set bit is the interrupt to service
+        i = (maskedInterrupts & -maskedInterrupts).bit_length() - 1
+        check = 1 << i
+
+        # Disable further interrupts
+        self.interrupts_enabled = False
+
+        # Clear the bit in the IS register
+        self.reg[IS] = self.reg[IS] ^ check
+        self.interrupts.update()
+
+        # push PC
+        self.reg[SP] = (self.reg[SP] - 1) & 0xFF
+        self.ram_write(self.pc, self.reg[SP])
+        # push FL
+        self.reg[SP] = (self.reg[SP] - 1) & 0xFF
+        self.ram_write(self.fl, self.reg[SP])
+        # push registers 0 - 6
+        for r in range(7):
+            self.PUSH(r)
+
+        # set PC to interrupt handler vector
+        # (vector table starts at 0xF8 in RAM)
+        self.pc = self.ram_read(0xF8 + i)
+
+    def poll(self):
+        """
+        Give the timer and other devices a chance to raise interrupts. Also
+        picks up any change to IM or IS made by arithmetic on those registers.
 
-        for i in range(8):
-            check = 1 << i
-            if maskedInterrupts & check:
-                # Disable further interrupts
-                self.interrupts_enabled = False
-
-                # Clear the bit in the IS register
-                self.reg[IS] = self.reg[IS] ^ check
-
-                # push PC
-                self.reg[SP] -= 1
-                self.ram_write(self.pc, self.reg[SP])
-                # push FL
-                self.reg[SP] -= 1
-                self.ram_write(self.fl, self.reg[SP])
-                # push registers 0 - 6
-                for r in range(7):
-                    self.PUSH(r)
-
-                # set PC to interrupt handler vector
-                # (vector table starts at 0xF8 in RAM)
-                self.pc = self.ram_read(0xF8 + i)
-
-                # stop further checking of maskedInterrupts
-                break
+        Returns the reason to stop if a run limit has been reached.
+        """
+
+        if self.cycles >= self.cycle_limit:
+            return "max_cycles"
+        if self.time_limit is not None and time.monotonic() >= self.time_limit:
+            return "timeout"
+
+        for device in self.devices:
+            device.poll(self)
+        self.interrupts.update()
+
+        if self.skip_idle:
+            self.measure_speed()
+
+        if (self.skip_idle and self.interrupts_enabled and self.reg[IM]
+                and not self.interrupts.pending):
+            length = self.idle_loop()
+            if length:
+                self.fast_forward(length)
+                # the time waited isn't time spent running either
+                self.speed_base = (time.monotonic(), self.cycles)
+                if self.cycles >= self.cycle_limit:
+                    return "max_cycles"
+                # hand over whatever ended the wait straight away
+                for device in self.devices:
+                    device.poll(self)
+                self.interrupts.update()
+
+        self.schedule()
+
+    def idle_loop(self):
+        """
+        If the CPU is in an idle loop, return its length in instructions,
+        otherwise 0.
+
+        An idle loop leads back to the PC within IDLE_LOOP_MAX instructions
+        and changes nothing on the way: JMPs, NOPs, and LDIs of the value a
+        register already holds. LOOP: JMP R0 is the usual one. Only an
+        interrupt gets the CPU out of it.
+        """
+
+        ram = self.ram
+        reg = self.reg
+        pc = self.pc
+
+        try:
+            for length in range(1, IDLE_LOOP_MAX + 1):
+                name = instr.get(ram[pc])
+                if name == "JMP" and ram[pc + 1] < len(reg):
+                    pc = reg[ram[pc + 1]]
+                elif name == "NOP":
+                    pc += 1
+                elif (name == "LDI" and ram[pc + 1] < len(reg)
+                      and reg[ram[pc + 1]] == ram[pc + 2]):
+                    pc += 3
+                else:
+                    return 0
+
+                if pc == self.pc:
+                    return length
+        except IndexError:
+            # runs off the end of RAM
+            pass
+
+        return 0
+
+    def measure_speed(self):
+        """
+        Update self.speed, the instructions per second the host runs this
+        CPU at, averaged over all the time it has spent executing.
+        """
+
+        now = time.monotonic()
+        if self.speed_base is None:
+            self.speed_base = (now, self.cycles)
+            return
+        base_time, base_cycles = self.speed_base
+        if self.cycles - base_cycles >= POLL_INTERVAL and now > base_time:
+            measured = self.measured
+            measured[0] += self.cycles - base_cycles
+            measured[1] += now - base_time
+            self.speed = measured[0] / measured[1]
+            self.speed_base = (now, self.cycles)
+
+    def fast_forward(self, length):
+        """
+        Skip through the idle loop, `length` instructions long, the CPU is
+        in, up to the next event that can interrupt it. The loop iterations
+        skipped are added to the instruction count, so it is what busy
+        waiting would have reached.
+
+        When only events due at known cycle counts can end the loop (an
+        emulated timer, a replayed interrupt or the run's cycle limit) the
+        CPU jumps straight to the next one. When something on the wall
+        clock can get in first (the timer on the wall clock, a key, the
+        run's timeout, or a throttled clock pacing the run), it waits for
+        it, counting the iterations it would have run meanwhile: at the
+        clock's rate when throttled, otherwise at the speed the CPU measured
+        itself running at. The wait ends once that count reaches the next
+        event due at a cycle count, so a run with a cycle limit never waits
+        longer than executing the loop would take.
+        """
+
+        clock = self.clock
+        self.schedule()
+        target = self.poll_limit
+
+        # wall clock time something will interrupt the CPU at, and a device
+        # whose input will
+        wake = math.inf
+        listener = None
+        for device in self.devices:
+            wake_time = getattr(device, "wake_time", None)
+            if wake_time is not None:
+                wake = min(wake, wake_time(self))
+            listening = getattr(device, "listening", None)
+            if listener is None and listening is not None and listening(self):
+                listener = device
+
+        now = time.monotonic()
+        paced = (clock.rate is not None and clock.throttle
+                 and clock.base_time is not None)
+        rate = clock.rate if paced else self.speed
+
+        # when the loop would reach target
+        if target == math.inf:
+            reach = math.inf
+        elif paced:
+            reach = clock.wall_time(target)
+        else:
+            reach = now + (target - self.cycles) / rate
+
+        time_limit = math.inf if self.time_limit is None else self.time_limit
+        if (not paced and listener is None and wake == math.inf
+                and target < math.inf and reach <= time_limit):
+            # nothing on the wall clock can get in first
+            self.skip_idle_loop(length, target)
+            return
+
+        deadline = min(wake, reach, time_limit)
+        if deadline == math.inf and listener is None:
+            # nothing will ever interrupt the CPU, keep spinning
+            return
+
+        timeout = None if deadline == math.inf else max(0.0, deadline - now)
+        # nothing printed so far waits along with the CPU
+        self.output.flush()
+        if listener is not None:
+            listener.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+        if paced:
+            reached = clock.cycles_at(time.monotonic())
+        else:
+            reached = self.cycles + int((time.monotonic() - now) * rate)
+        self.skip_idle_loop(length, min(target, reached))
+
+    def skip_idle_loop(self, length, target):
+        """Count as run the whole idle loop iterations up to cycle target."""
+
+        if target > self.cycles:
+            self.cycles += int(target - self.cycles) // length * length
+
+    # Implementation of ALU instruction handlers
+    def ADD(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] + self.reg[reg_b]) & 0xFF
+
+    def AND(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] & self.reg[reg_b]
+
+    def CMP(self, reg_a, reg_b):
+        """
+        The flags register FL holds the current flags status. These flags can change based on the
+        operands given to the CMP opcode.
+        The register is made up of 8 bits. If a particular bit is set, that flag is "true".
+
+        FL bits: 00000LGE
+
+        L Less-than: during a CMP, set to 1 if registerA is less than registerB, zero otherwise.
+        G Greater-than: during a CMP, set to 1 if registerA is greater than registerB, zero otherwise.
+        E Equal: during a CMP, set to 1 if registerA is equal to registerB, zero otherwise.
+        """
+
+        if self.reg[reg_a] == self.reg[reg_b]:
+            self.fl = 1
+        elif self.reg[reg_a] > self.reg[reg_b]:
+            self.fl = 2
+        elif self.reg[reg_a] < self.reg[reg_b]:
+            self.fl = 4
+        else:
+            raise Exception(
+                "CMP: Invalid inputs or error computing result")
+
+    def DEC(self, reg):
+        self.reg[reg] = (self.reg[reg] - 1) & 0xFF
+
+    def DIV(self, reg_a, reg_b):
+        if not self.reg[reg_b]:
+            raise Exception("DIV: Division by zero")
+        self.reg[reg_a] = self.reg[reg_a] // self.reg[reg_b]
+
+    def INC(self, reg):
+        self.reg[reg] = (self.reg[reg] + 1) & 0xFF
+
+    def MOD(self, reg_a, reg_b):
+        if not self.reg[reg_b]:
+            raise Exception("MOD: Division by zero")
+        self.reg[reg_a] = self.reg[reg_a] % self.reg[reg_b]
+
+    def MUL(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] * self.reg[reg_b]) & 0xFF
+
+    def NOT(self, reg):
+        self.reg[reg] = ~self.reg[reg] & 0xFF
+
+    def OR(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] | self.reg[reg_b]
+
+    def SHL(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] << self.reg[reg_b]) & 0xFF
+
+    def SHR(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] >> self.reg[reg_b]
+
+    def SUB(self, reg_a, reg_b):
+        self.reg[reg_a] = (self.reg[reg_a] - self.reg[reg_b]) & 0xFF
+
+    def XOR(self, reg_a, reg_b):
+        self.reg[reg_a] = self.reg[reg_a] ^ self.reg[reg_b]
 
     # Implementation of non-ALU instructions handlers
     def CALL(self, reg):
@@ -311,12 +1239,18 @@ class CPU:
         """
 
         # PUSH
-        self.reg[SP] -= 1
-        self.ram_write(self.pc + 2, self.reg[SP])
+        self.reg[SP] = (self.reg[SP] - 1) & 0xFF
+        self.ram_write((self.pc + 2) & 0xFF, self.reg[SP])
 
         # Set PC to address in the given reg
         self.pc = self.reg[reg]
 
+    def HLT(self):
+        """
+        Halt the CPU. Ends the current run().
+        """
+        raise Halted()
+
     def INT(self, reg):
         """
         Issue the interrupt number stored in the given register.
@@ -329,7 +1263,10 @@ class CPU:
                 f"INT: Invalid interrupt provided: {interrupt_num}")
 
         # set the appropriate bit for the requested interrupt
-        self.reg[IS] = self.reg[IS] | (0b1 << interrupt_num)
+        self.interrupts.raise_interrupt(interrupt_num)
+
+        # INT is flagged as setting the PC, so move past it here
+        self.pc += 2
 
     def IRET(self):
         """
@@ -343,14 +1280,18 @@ class CPU:
             # pop off values for the states of the six registers that existed
             # before the interrupt handler was called
             self.reg[r] = self.ram_read(self.reg[SP])
-            self.reg[SP] += 1
+            self.reg[SP] = (self.reg[SP] + 1) & 0xFF
 
         self.fl = self.ram_read(self.reg[SP])   # pop off FL
-        self.reg[SP] += 1
+        self.reg[SP] = (self.reg[SP] + 1) & 0xFF
         self.pc = self.ram_read(self.reg[SP])   # pop off PC
-        self.reg[SP] += 1
+        self.reg[SP] = (self.reg[SP] + 1) & 0xFF
 
         self.interrupts_enabled = True
+        if self.keyboard is not None and self.keyboard.keys:
+            # hand over the next queued key now rather than at the next poll
+            self.keyboard.poll(self)
+        self.interrupts.update()
 
     def JEQ(self, reg):
         raise Exception("Instruction not yet implemented: JEQ")
@@ -377,12 +1318,19 @@ class CPU:
         raise Exception("Instruction not yet implemented: JNE")
 
     def LD(self, reg_a, reg_b):
-        raise Exception("Instruction not yet implemented: LD")
+        """
+        Load reg_a with the value at the memory address stored in reg_b
+        """
+        self.reg[reg_a] = self.ram_read(self.reg[reg_b])
+        if reg_a == IM or reg_a == IS:
+            self.interrupts.update()
 
     def LDI(self, reg, val):
         # Load immediate value into a register
         if reg >= 0 and reg <= 7:
             self.reg[reg] = val
+            if reg == IM or reg == IS:
+                self.interrupts.update()
         else:
             raise Exception(f"Invalid register requested for LDI: {reg}")
 
@@ -397,7 +1345,9 @@ class CPU:
         2. Increment SP.
         """
         self.reg[reg] = self.ram_read(self.reg[SP])
-        self.reg[SP] += 1
+        self.reg[SP] = (self.reg[SP] + 1) & 0xFF
+        if reg == IM or reg == IS:
+            self.interrupts.update()
 
     def PRA(self, reg):
         """
@@ -405,14 +1355,14 @@ class CPU:
         Print to the console the ASCII character corresponding to the value in the register.
         """
 
-        print(chr(self.reg[reg]))
+        self.output.write_char(self.reg[reg])
 
     def PRN(self, reg):
         """
         Print to the console the decimal integer value that is stored in the given register.
         """
         if reg >= 0 and reg <= 7:    # should this be 4 since 5,6,7 are reserved?
-            print(self.reg[reg])
+            self.output.write_int(self.reg[reg])
         else:
             raise Exception(f"Invalid register requested for PRN: {reg}")
 
@@ -422,7 +1372,7 @@ class CPU:
         1. Decrement the SP.
         2. Copy the value in the given register to the address pointed to by SP.
         """
-        self.reg[SP] -= 1
+        self.reg[SP] = (self.reg[SP] - 1) & 0xFF
         self.ram_write(self.reg[reg], self.reg[SP])
 
     def RET(self):
@@ -433,7 +1383,7 @@ class CPU:
 
         # POP
         self.pc = self.ram_read(self.reg[SP])
-        self.reg[SP] += 1
+        self.reg[SP] = (self.reg[SP] + 1) & 0xFF
 
     def ST(self, reg_a, reg_b):
         """
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+
+"""
+Breakpoint and watchpoint debugger for the LS-8.
+
+Usage: debugger.py program.ls8
+
+From a script:
+
+    cpu = DebugCPU()
+    cpu.load("examples/call.ls8")
+    cpu.add_breakpoint(0x18)
+    while cpu.run() == "breakpoint":
+        print(cpu.reg[0])
+"""
+
+import cmd
+import shlex
+import sys
+
+from cpu import *
+
+
+class DebugCPU(CPU):
+    """
+    CPU with breakpoints, watchpoints and stop conditions.
+
+    While none are set run() is CPU.run(), so an idle debugger costs
+    nothing. Otherwise it switches to an instrumented loop that stops:
+
+        before executing an instruction at a breakpoint ("breakpoint"),
+        after an instruction writes a watched RAM address ("watchpoint"),
+        after an instruction changes a watched register ("register"),
+        after an instruction leaves a condition true ("condition").
+
+    The reason is returned like "halted" or "max_cycles", and self.event
+    holds the details. Calling run() again continues from where it stopped.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.breakpoints = set()
+        self.watchpoints = set()
+        self.registers = {}         # register -> predicate on the new value
+        self.conditions = []        # callables taking the cpu
+        self.event = None           # details of the last stop
+        self.watch_hits = []
+        # PC of the last "breakpoint" stop, which the next run() executes
+        self.breakpoint_pc = None
+
+    def fork(self):
+        child = super().fork()
+        child.breakpoints = set(self.breakpoints)
+        child.watchpoints = set(self.watchpoints)
+        child.registers = dict(self.registers)
+        child.conditions = list(self.conditions)
+        child.breakpoint_pc = self.breakpoint_pc
+        return child
+
+    def add_breakpoint(self, addr):
+        self.breakpoints.add(addr)
+
+    def remove_breakpoint(self, addr):
+        self.breakpoints.discard(addr)
+
+    def add_watchpoint(self, addr):
+        self.watchpoints.add(addr)
+
+    def remove_watchpoint(self, addr):
+        self.watchpoints.discard(addr)
+
+    def watch_register(self, reg, predicate=None):
+        """
+        Stop when reg changes, or only when predicate(new value) is true for
+        the changed value if a predicate is given.
+        """
+        self.registers[reg] = predicate
+
+    def unwatch_register(self, reg):
+        self.registers.pop(reg, None)
+
+    def add_condition(self, condition):
+        """Stop when condition(cpu) is true after an instruction."""
+        self.conditions.append(condition)
+        return condition
+
+    def remove_condition(self, condition):
+        self.conditions.remove(condition)
+
+    def clear(self):
+        """Remove every breakpoint, watchpoint and condition."""
+        self.breakpoints.clear()
+        self.watchpoints.clear()
+        self.registers.clear()
+        self.conditions.clear()
+
+    def ram_write(self, val, addr):
+        if addr in self.watchpoints:
+            self.watch_hits.append(("watchpoint", addr, self.ram[addr], val))
+        super().ram_write(val, addr)
+
+    def step(self, count=1):
+        """
+        Execute count instructions, stopping early at anything being watched.
+        Returns "step" when all of them ran.
+        """
+
+        reason = self.run(max_cycles=count)
+        return "step" if reason == "max_cycles" else reason
+
+    def run_until(self, condition, max_cycles=None, timeout=None):
+        """Run until condition(cpu) is true, or anything else stops the CPU."""
+
+        self.add_condition(condition)
+        try:
+            return self.run(max_cycles, timeout)
+        finally:
+            self.remove_condition(condition)
+
+    def run(self, max_cycles=None, timeout=None):
+        """Run the CPU, stopping at breakpoints and watched events."""
+
+        self.event = None
+        self.watch_hits.clear()
+        # continuing from a breakpoint executes the instruction there, but
+        # only the one it stopped at
+        resume = self.breakpoint_pc
+        self.breakpoint_pc = None
+
+        if not (self.breakpoints or self.watchpoints or self.registers
+                or self.conditions):
+            return super().run(max_cycles, timeout)
+
+        pc, cycles, next_poll = self.start_run(max_cycles, timeout)
+
+        breakpoints = self.breakpoints
+        watched = self.registers
+        conditions = self.conditions
+        watch_hits = self.watch_hits
+
+        reg = self.reg
+        execute = self.execute
+        interrupts = self.interrupts
+
+        try:
+            while True:
+                if cycles >= next_poll:
+                    stopped, cycles, next_poll = self.poll_point(pc, cycles)
+                    if stopped:
+                        return stopped
+
+                if interrupts.pending:
+                    pc = self.interrupt_point(pc)
+
+                if pc in breakpoints and pc != resume:
+                    self.event = ("breakpoint", pc)
+                    self.breakpoint_pc = pc
+                    return "breakpoint"
+                resume = None
+
+                before = bytes(reg) if watched else None
+
+                cycles += 1
+                pc = execute(pc)
+
+                if watch_hits:
+                    self.event = watch_hits.pop(0)
+                    return "watchpoint"
+
+                if watched and before != reg:
+                    for r, predicate in watched.items():
+                        if before[r] != reg[r] and (predicate is None
+                                                    or predicate(reg[r])):
+                            self.event = ("register", r, before[r], reg[r])
+                            return "register"
+
+                if conditions:
+                    self.pc = pc
+                    self.cycles = cycles
+                    for condition in conditions:
+                        if condition(self):
+                            self.event = ("condition", condition)
+                            return "condition"
+        except Halted:
+            return "halted"
+        finally:
+            self.end_run(pc, cycles)
+
+
+def parse_number(text):
+    """Parse an address or value: 0x1F, 0b101 or decimal."""
+
+    try:
+        return int(text, 0)
+    except ValueError:
+        raise ValueError(f"not a number: {text!r}") from None
+
+
+class DebuggerShell(cmd.Cmd):
+    """Interactive front end to DebugCPU."""
+
+    prompt = "(ls8) "
+
+    def __init__(self, cpu):
+        super().__init__()
+        self.cpu = cpu
+
+    def onecmd(self, line):
+        # a mistyped command or a fault in the program ends the command,
+        # not the session
+        try:
+            return super().onecmd(line)
+        except KeyboardInterrupt:
+            print("interrupted")
+            self.cpu.trace()
+        except Exception as e:
+            print(f"error: {e}")
+
+    def report(self, reason):
+        if self.cpu.event is not None:
+            print(f"{reason}: {self.cpu.event}")
+        else:
+            print(reason)
+        self.cpu.trace()
+
+    def address(self, arg):
+        """An address given as a number or a label of the loaded program."""
+
+        if not arg:
+            raise ValueError("expected an address or label")
+        if arg in self.cpu.symbols:
+            return self.cpu.symbols[arg]
+        try:
+            return int(arg, 0)
+        except ValueError:
+            raise ValueError(f"no label or address {arg!r}") from None
+
+    def do_break(self, arg):
+        """break ADDR|LABEL: stop before executing the instruction at ADDR"""
+        self.cpu.add_breakpoint(self.address(arg))
+
+    def do_watch(self, arg):
+        """watch ADDR: stop after RAM at ADDR is written"""
+        self.cpu.add_watchpoint(self.address(arg))
+
+    def do_rwatch(self, arg):
+        """rwatch REG [VALUE]: stop when register REG changes (to VALUE)"""
+        args = shlex.split(arg)
+        if not args:
+            raise ValueError("usage: rwatch REG [VALUE]")
+        predicate = None
+        if len(args) > 1:
+            value = parse_number(args[1])
+            predicate = lambda new: new == value
+        self.cpu.watch_register(parse_number(args[0]), predicate)
+
+    def do_delete(self, arg):
+        """delete: remove all breakpoints, watchpoints and conditions"""
+        self.cpu.clear()
+
+    def do_step(self, arg):
+        """step [N]: execute N instructions (default 1)"""
+        self.report(self.cpu.step(parse_number(arg) if arg else 1))
+
+    def do_continue(self, arg):
+        """continue [MAX_CYCLES]: run until something stops the CPU"""
+        self.report(self.cpu.run(parse_number(arg) if arg else None))
+
+    def do_regs(self, arg):
+        """regs: show PC, registers and flags"""
+        self.cpu.trace()
+        print(f"FL: {self.cpu.fl:08b}  cycles: {self.cpu.cycles}")
+
+    def do_mem(self, arg):
+        """mem ADDR [COUNT]: dump COUNT bytes of RAM from ADDR"""
+        args = shlex.split(arg)
+        if not args:
+            raise ValueError("usage: mem ADDR [COUNT]")
+        start = self.address(args[0])
+        count = parse_number(args[1]) if len(args) > 1 else 16
+        print(" ".join("%02X" % b for b in self.cpu.ram[start:start + count]))
+
+    def do_quit(self, arg):
+        """quit: leave the debugger"""
+        return True
+
+    do_b = do_break
+    do_s = do_step
+    do_c = do_continue
+    do_q = do_quit
+    do_EOF = do_quit
+
+
+def main(argv):
+    if len(argv) != 2:
+        print("usage: debugger.py program.ls8", file=sys.stderr)
+        return 1
+
+    cpu = DebugCPU()
+    cpu.load(argv[1])
+    DebuggerShell(cpu).cmdloop()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,135 @@
+"""Pre-decoded instruction cache for the LS-8."""
+
+from cpu import *
+
+
+class DecodedCPU(CPU):
+    """
+    CPU that decodes each address once and caches the result.
+
+    The cache holds, per address, the handler, number of operands, whether
+    it sets the PC and the operand bytes, filled in the first time the
+    address is executed. run() then skips re-reading the
+    operands from RAM and unpacking the opcode bits on every later visit.
+
+    Writes through ram_write() drop every entry covering the written byte. In
+    clear mode (clear_on_write=True) any write that lands on decoded code
+    drops the whole cache instead, which is simpler for programs that
+    rewrite large parts of themselves. load(), load_image() and restore()
+    always start from an empty cache. Code that writes to self.ram directly
+    must call flush() itself.
+    """
+
+    def __init__(self, clear_on_write=False):
+        super().__init__()
+        self.clear_on_write = clear_on_write
+        # address -> (handler, num_operands, sets_pc, operand_a, operand_b)
+        self.decoded = [None] * len(self.ram)
+        # nonzero for every byte some decoded entry may cover, so writes to
+        # data such as the stack skip the invalidation check
+        self.covered = bytearray(len(self.ram))
+
+    def load(self, filename=None):
+        super().load(filename)
+        self.flush()
+
+    def load_image(self, source):
+        super().load_image(source)
+        self.flush()
+
+    def restore(self, state, offset=0):
+        super().restore(state, offset)
+        self.flush()
+
+    def fork(self):
+        child = super().fork()
+        child.clear_on_write = self.clear_on_write
+        return child
+
+    def ram_write(self, val, addr):
+        # CPU.ram_write inlined, this sits under every PUSH, CALL and ST
+        if addr < len(self.ram):
+            self.ram[addr] = val
+        else:
+            raise Exception("Memory address out of range!")
+        if self.covered[addr]:
+            self.invalidate(addr)
+
+    def invalidate(self, addr):
+        """Drop the decoded entries covering addr, or all of them in clear mode."""
+
+        decoded = self.decoded
+        # entries at addr, addr - 1 and addr - 2 may cover this byte
+        for start in range(addr, max(addr - 3, -1), -1):
+            entry = decoded[start]
+            if entry is not None and start + entry[1] >= addr:
+                if self.clear_on_write:
+                    self.flush()
+                    return
+                decoded[start] = None
+
+    def flush(self):
+        """Throw away every decoded instruction."""
+        self.decoded[:] = [None] * len(self.decoded)
+        self.covered[:] = bytes(len(self.covered))
+
+    def decode(self, pc):
+        """Decode the instruction at pc and cache it."""
+
+        ram = self.ram
+        handler, num_operands, sets_pc = self.dispatch[ram[pc]]
+        # operands past the end of RAM fail here like they do in CPU.run()
+        operand_a = ram[pc + 1] if num_operands >= 1 else 0
+        operand_b = ram[pc + 2] if num_operands == 2 else 0
+
+        entry = (handler, num_operands, sets_pc, operand_a, operand_b)
+        self.decoded[pc] = entry
+        self.covered[pc:pc + num_operands + 1] = bytes([1]) * (num_operands + 1)
+        return entry
+
+    def run(self, max_cycles=None, timeout=None):
+        """Run the CPU like CPU.run(), fetching from the decode cache."""
+
+        pc, cycles, next_poll = self.start_run(max_cycles, timeout)
+
+        decoded = self.decoded
+        decode = self.decode
+        interrupts = self.interrupts
+
+        try:
+            while True:
+                if cycles >= next_poll:
+                    stopped, cycles, next_poll = self.poll_point(pc, cycles)
+                    if stopped:
+                        return stopped
+
+                if interrupts.pending:
+                    pc = self.interrupt_point(pc)
+
+                entry = decoded[pc]
+                if entry is None:
+                    entry = decode(pc)
+                handler, num_operands, sets_pc, operand_a, operand_b = entry
+                # inlined like CPU.run(), with the cached operands
+                cycles += 1
+
+                if sets_pc:
+                    self.pc = pc
+                    if num_operands == 0:
+                        handler()
+                    else:
+                        handler(operand_a)
+                    pc = self.pc
+                elif num_operands == 0:
+                    handler()
+                    pc += 1
+                elif num_operands == 1:
+                    handler(operand_a)
+                    pc += 2
+                else:
+                    handler(operand_a, operand_b)
+                    pc += 3
+        except Halted:
+            return "halted"
+        finally:
+            self.end_run(pc, cycles)
@@ -0,0 +1,155 @@
+"""
+Interchangeable execution engines for the LS-8.
+
+Every engine is a CPU subclass. The machine state (registers, RAM, PC, FL,
+interrupt state and cycle count), loading and the devices all live in CPU
+and are shared; an engine only replaces run(max_cycles, timeout), which
+executes instructions and returns why it stopped: "halted", "max_cycles",
+"timeout", or an engine-specific reason such as the debugger's
+"breakpoint".
+
+A run() is built from CPU's run loop helpers: start_run() before the loop,
+poll_point() once the cycle count reaches the next poll, interrupt_point()
+while an interrupt is pending and end_run() on the way out. The engine
+supplies the step in between, usually execute(), which fetches and
+executes one instruction.
+
+Engines are looked up by name, so callers like ls8.py and bench.py can
+switch between them, and conform() runs two side by side to check a faster
+engine against the reference one.
+"""
+
+import importlib
+import io
+import math
+
+from cpu import *
+
+
+class ReferenceCPU(CPU):
+    """The original string-dispatch interpreter, see CPU.run_reference()."""
+
+    def run(self, max_cycles=None, timeout=None):
+        return self.run_reference(max_cycles, timeout)
+
+
+# engine name -> (module, class), imported when first used
+ENGINES = {
+    "reference": ("engines", "ReferenceCPU"),
+    "cpu": ("cpu", "CPU"),
+    "decoded": ("decode", "DecodedCPU"),
+    "block": ("translate", "BlockCPU"),
+    "traced": ("tracer", "TracingCPU"),
+    "profiled": ("profiler", "ProfilingCPU"),
+    "debug": ("debugger", "DebugCPU"),
+}
+
+# engines whose cycle count stops exactly at max_cycles, which conform()
+# needs from the engine it checks against
+EXACT = {"reference", "cpu", "decoded", "traced", "profiled", "debug"}
+
+# engines that collect a trace or profile, and the tool that writes it out
+TOOLS = {"traced": "tracer.py", "profiled": "profiler.py"}
+
+
+def engine_class(name):
+    """Return the CPU class for an engine name."""
+
+    if name not in ENGINES:
+        raise ValueError(f"unknown engine {name}, "
+                         f"expected one of {', '.join(ENGINES)}")
+
+    module, cls = ENGINES[name]
+    return getattr(importlib.import_module(module), cls)
+
+
+def create(name):
+    """Return a new CPU running on the named engine."""
+    return engine_class(name)()
+
+
+def differences(a, b):
+    """List the parts of two CPUs' state that differ, as strings."""
+
+    diffs = []
+
+    if a.pc != b.pc:
+        diffs.append(f"PC: {a.pc:02X} != {b.pc:02X}")
+    if a.fl != b.fl:
+        diffs.append(f"FL: {a.fl:08b} != {b.fl:08b}")
+    if a.interrupts_enabled != b.interrupts_enabled:
+        diffs.append(f"interrupts enabled: {a.interrupts_enabled} != "
+                     f"{b.interrupts_enabled}")
+    for r in range(8):
+        if a.reg[r] != b.reg[r]:
+            diffs.append(f"R{r}: {a.reg[r]:02X} != {b.reg[r]:02X}")
+    if a.ram != b.ram:
+        for addr in range(len(a.ram)):
+            if a.ram[addr] != b.ram[addr]:
+                diffs.append(f"RAM[{addr:02X}]: {a.ram[addr]:02X} != "
+                             f"{b.ram[addr]:02X}")
+
+    return diffs
+
+
+def conform(a, b, max_cycles=1_000_000, step=1):
+    """
+    Run CPUs a and b, loaded with the same program, in lockstep and return
+    the first divergence, or None if they agree for max_cycles
+    instructions or until both halt.
+
+    b runs step instructions at a time and a is then brought to the same
+    cycle count, so a must stop exactly at its limit (see EXACT) while b
+    may overshoot, as the block engine does. The state, output and stop
+    reasons are compared at every such point. The timer is stopped on both,
+    so only INT raises interrupts and the runs are deterministic.
+
+    A divergence is a dict with the cycle count it was found at, the PC and
+    instruction b started the step from, and the differences.
+    """
+
+    outputs = []
+    for cpu in (a, b):
+        cpu.timer.interval = math.inf
+        cpu.timer.set_state(math.inf)
+        output = io.StringIO()
+        cpu.set_output(OutputDevice(output))
+        outputs.append(output)
+
+    while b.cycles < max_cycles:
+        pc = b.pc
+        instruction = " ".join("%02X" % byte for byte in b.ram[pc:pc + 3])
+
+        reason_b = run_guarded(b, step)
+        reason_a = "max_cycles"
+        if a.cycles < b.cycles:
+            reason_a = run_guarded(a, b.cycles - a.cycles)
+
+        diffs = []
+        if a.cycles != b.cycles:
+            diffs.append(f"cycles: {a.cycles} != {b.cycles}")
+        if reason_a != reason_b:
+            diffs.append(f"stopped: {reason_a} != {reason_b}")
+        diffs += differences(a, b)
+        if outputs[0].getvalue() != outputs[1].getvalue():
+            diffs.append(f"output: {outputs[0].getvalue()[-20:]!r} != "
+                         f"{outputs[1].getvalue()[-20:]!r}")
+
+        if diffs:
+            return {"cycles": b.cycles, "pc": pc, "instruction": instruction,
+                    "differences": diffs}
+
+        if reason_b != "max_cycles":
+            # both stopped the same way, halted or failed
+            return None
+
+    return None
+
+
+def run_guarded(cpu, cycles):
+    """Run a CPU, turning an exception into a stop reason to compare."""
+
+    try:
+        return cpu.run(max_cycles=cycles)
+    except Exception as e:
+        return f"error: {e}"
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+"""
+Coverage-guided fuzzer for LS-8 programs.
+
+Usage: fuzzer.py program.ls8 [--time SECONDS] [--jobs N] [--registers LO-HI]
+                 [--data LO-HI] [--max-cycles N] [--out DIR] [--seed N]
+
+An input is the starting value of some registers (R0-R4 by default) and of
+a range of RAM (by default from the end of the program up to the stack).
+Each execution restores the machine from an in-memory snapshot, writes the
+input over it and runs the program for at most --max-cycles instructions,
+recording which (previous PC, PC) edges it took. Inputs that take an edge
+no earlier input took join the corpus and get mutated further.
+
+Crashes are exceptions from the emulator (invalid instructions, RAM out of
+range, division by zero, a jump through a register that doesn't exist) and
+the stack growing down into the program. Each distinct crash, by PC and
+message, is minimized by zeroing every input byte the crash doesn't need.
+
+The search runs in rounds on a process per core, with the corpus and
+coverage merged between rounds.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import random
+import re
+import sys
+import time
+
+from cpu import *
+from tracedecode import parse_range
+
+# edge coverage: one bit for every (previous PC, PC) pair
+MAP_SIZE = 256 * 256 // 8
+
+# values that tend to find edge cases, tried more often than chance would
+INTERESTING = (0x00, 0x01, 0x02, 0x07, 0x08, 0x7F, 0x80, 0xF3, 0xF4, 0xF8,
+               0xFE, 0xFF)
+
+# seconds each worker fuzzes before its finds are merged
+ROUND = 1.0
+
+
+class StackCollision(Exception):
+    """Raised when the stack grows down into the program."""
+
+
+class FuzzCPU(CPU):
+    """
+    CPU whose run() records edge coverage into self.edges, a set of
+    previous PC << 8 | PC, and which raises StackCollision when a push takes
+    SP below stack_floor.
+    """
+
+    def __init__(self, stack_floor=0):
+        super().__init__()
+        self.edges = set()
+        self.stack_floor = stack_floor
+
+    def fork(self):
+        child = super().fork()
+        child.stack_floor = self.stack_floor
+        return child
+
+    def check_stack(self):
+        if self.reg[SP] < self.stack_floor:
+            raise StackCollision("Stack ran into the program")
+
+    def PUSH(self, reg):
+        super().PUSH(reg)
+        self.check_stack()
+
+    def CALL(self, reg):
+        super().CALL(reg)
+        self.check_stack()
+
+    def check_interrupts(self):
+        super().check_interrupts()
+        self.check_stack()
+
+    def run(self, max_cycles=None, timeout=None):
+        """Run the CPU like CPU.run(), recording the edges taken."""
+
+        pc, cycles, next_poll = self.start_run(max_cycles, timeout)
+
+        add = self.edges.add
+        execute = self.execute
+        interrupts = self.interrupts
+        prev = pc
+
+        try:
+            while True:
+                if cycles >= next_poll:
+                    stopped, cycles, next_poll = self.poll_point(pc, cycles)
+                    if stopped:
+                        return stopped
+
+                if interrupts.pending:
+                    pc = self.interrupt_point(pc)
+
+                add(prev << 8 | pc)
+                prev = pc
+
+                cycles += 1
+                pc = execute(pc)
+        except Halted:
+            return "halted"
+        finally:
+            self.end_run(pc, cycles)
+
+
+def to_bitmap(edges):
+    """Pack a set of edges into a MAP_SIZE byte bitmap."""
+
+    bitmap = bytearray(MAP_SIZE)
+    for edge in edges:
+        bitmap[edge >> 3] |= 1 << (edge & 7)
+    return bitmap
+
+
+def from_bitmap(bitmap):
+    """Unpack a bitmap into the set of edges it holds."""
+
+    edges = set()
+    for i, byte in enumerate(bitmap):
+        while byte:
+            low = byte & -byte
+            edges.add(i << 3 | low.bit_length() - 1)
+            byte ^= low
+    return edges
+
+
+def signature(cpu, error):
+    """What makes a crash distinct: where it happened and what it was."""
+    return (cpu.pc, re.sub(r"\d+", "#", str(error)))
+
+
+class Fuzzer:
+    """
+    Mutates inputs for one loaded program and keeps those that find new
+    coverage. state is a CPU snapshot() of the loaded program, registers
+    and data the register numbers and RAM addresses an input sets.
+    """
+
+    def __init__(self, state, registers=range(5), data=range(0), stack_floor=0,
+                 max_cycles=10_000, seed=None):
+        self.cpu = FuzzCPU(stack_floor)
+        self.cpu.restore(state)
+        # stop the timer so every run of an input is the same
+        self.cpu.timer.interval = math.inf
+        self.cpu.timer.set_state(math.inf)
+        self.cpu.set_output(OutputDevice(NullWriter()))
+        self.base = self.cpu.snapshot()
+
+        self.registers = list(registers)
+        self.data = data
+        self.max_cycles = max_cycles
+        self.random = random.Random(seed)
+
+        self.coverage = set()
+        self.corpus = []
+        self.crashes = {}       # signature -> minimized input
+        self.execs = 0
+
+        # mutations start from the initial input even if it crashes
+        initial = self.initial_input()
+        self.add_input(initial)
+        if not self.corpus:
+            self.corpus.append(initial)
+
+    def initial_input(self):
+        """The input the program starts with when it's simply loaded."""
+
+        cpu = self.cpu
+        return (bytes(cpu.reg[r] for r in self.registers)
+                + bytes(cpu.ram[self.data.start:self.data.stop]))
+
+    def execute(self, data):
+        """
+        Run the program on an input. Returns the crash signature, or None if
+        it didn't crash, and the edges it took.
+        """
+
+        cpu = self.cpu
+        cpu.restore(self.base)
+        reg = cpu.reg
+        for i, r in enumerate(self.registers):
+            reg[r] = data[i]
+        cpu.ram[self.data.start:self.data.stop] = data[len(self.registers):]
+        cpu.interrupts.update()
+        cpu.edges = edges = set()
+
+        self.execs += 1
+        try:
+            cpu.run(max_cycles=self.max_cycles)
+        except Exception as e:
+            return signature(cpu, e), edges
+        return None, edges
+
+    def add_input(self, data):
+        """Run an input, keeping it if it crashes or finds new edges."""
+
+        crash, edges = self.execute(data)
+        new = not edges <= self.coverage
+        self.coverage |= edges
+
+        if crash is not None:
+            if crash not in self.crashes:
+                self.crashes[crash] = self.minimize(data, crash)
+        elif new:
+            self.corpus.append(data)
+
+        return new
+
+    def mutate(self, data):
+        """A copy of data with a few random changes stacked up."""
+
+        getrandbits = self.random.getrandbits
+        data = bytearray(data)
+        size = len(data)
+        if not size:
+            return bytes(data)
+
+        # one random number per change, split into the fields it needs,
+        # is a good deal cheaper than a randrange() call for each
+        for _ in range(1 << getrandbits(2)):
+            bits = getrandbits(32)
+            kind = bits & 7
+            i = (bits >> 3 & 0xFFFF) % size
+            value = bits >> 19 & 0xFF
+            if kind <= 1:
+                data[i] ^= 1 << (value & 7)
+            elif kind <= 3:
+                data[i] = value
+            elif kind == 4:
+                data[i] = INTERESTING[value % len(INTERESTING)]
+            elif kind == 5:
+                data[i] = (data[i] + (value & 0x1F) - 16) & 0xFF
+            elif kind == 6:
+                # splice in part of another corpus input
+                other = self.corpus[(bits >> 27) % len(self.corpus)]
+                j = i + 1 + value % (size - i)
+                data[i:j] = other[i:j]
+            else:
+                data[i] = 0
+
+        return bytes(data)
+
+    def fuzz(self, seconds):
+        """Mutate corpus inputs for the given number of seconds."""
+
+        deadline = time.monotonic() + seconds
+        choice = self.random.choice
+        mutate = self.mutate
+        add_input = self.add_input
+
+        while time.monotonic() < deadline:
+            for _ in range(256):
+                add_input(mutate(choice(self.corpus)))
+
+    def minimize(self, data, crash):
+        """Zero every byte of a crashing input that the crash doesn't need."""
+
+        data = bytearray(data)
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(data)):
+                if data[i]:
+                    kept = data[i]
+                    data[i] = 0
+                    if self.execute(bytes(data))[0] == crash:
+                        changed = True
+                    else:
+                        data[i] = kept
+
+        return bytes(data)
+
+    def merge(self, corpus, bitmap, crashes):
+        """Take in the corpus, coverage and crashes other fuzzers found."""
+
+        known = set(self.corpus)
+        self.corpus.extend(data for data in corpus if data not in known)
+        self.coverage |= from_bitmap(bitmap)
+        for crash, data in crashes.items():
+            self.crashes.setdefault(crash, data)
+
+
+def init_worker(state, options, seed):
+    global worker
+    worker = Fuzzer(state, seed=seed ^ os.getpid(), **options)
+
+
+def fuzz_round(corpus, bitmap, crashes, seconds):
+    """One round in a worker process. Returns what it found."""
+
+    worker.merge(corpus, bitmap, crashes)
+    known = len(worker.corpus)
+    execs = worker.execs
+    worker.fuzz(seconds)
+
+    return (worker.corpus[known:], to_bitmap(worker.coverage), worker.crashes,
+            worker.execs - execs)
+
+
+def fuzz_parallel(state, options, seconds, jobs=None, seed=None, report=None):
+    """
+    Fuzz with a process per core for the given number of seconds. options
+    are Fuzzer arguments. report, if given, is called with a stats dict
+    after every round. Returns the corpus, the coverage bitmap, the
+    crashes and the number of executions.
+    """
+
+    jobs = jobs or os.cpu_count() or 1
+    if seed is None:
+        seed = random.randrange(1 << 32)
+
+    # the parent's own fuzzer keeps the merged results
+    merged = Fuzzer(state, seed=seed, **options)
+    execs = merged.execs
+    start = time.monotonic()
+    deadline = start + seconds
+
+    with concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=init_worker,
+            initargs=(state, options, seed)) as pool:
+
+        def submit():
+            left = deadline - time.monotonic()
+            return pool.submit(fuzz_round, list(merged.corpus),
+                               to_bitmap(merged.coverage), dict(merged.crashes),
+                               max(0.0, min(ROUND, left)))
+
+        running = {submit() for _ in range(jobs)}
+        while running:
+            done, running = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                corpus, bitmap, crashes, round_execs = future.result()
+                execs += round_execs
+                merged.merge(corpus, bitmap, crashes)
+                if time.monotonic() < deadline:
+                    running.add(submit())
+
+            if report is not None:
+                elapsed = time.monotonic() - start
+                report({"elapsed": elapsed, "execs": execs,
+                        "execs_per_sec": execs / elapsed if elapsed else 0.0,
+                        "corpus": len(merged.corpus),
+                        "edges": len(merged.coverage),
+                        "crashes": len(merged.crashes)})
+
+    return merged.corpus, to_bitmap(merged.coverage), merged.crashes, execs
+
+
+def format_input(data, registers, addresses):
+    """Describe an input: its registers and nonzero RAM bytes."""
+
+    parts = [f"R{r}={data[i]:02X}" for i, r in enumerate(registers)]
+    offset = len(registers)
+    parts += [f"[{addr:02X}]={data[offset + i]:02X}"
+              for i, addr in enumerate(addresses) if data[offset + i]]
+    return " ".join(parts)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Coverage-guided fuzzer for LS-8 programs.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("--time", type=float, default=10,
+                        help="seconds to fuzz for (default 10)")
+    parser.add_argument("--jobs", type=int,
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--registers", default="0-4",
+                        help="registers the input sets (default 0-4)")
+    parser.add_argument("--data",
+                        help="RAM addresses the input sets, e.g. 0x40-0x7F "
+                             "(default: the end of the program up to 0xF3)")
+    parser.add_argument("--max-cycles", type=int, default=10_000,
+                        help="instructions per run (default 10000)")
+    parser.add_argument("--out", help="write the crashes, corpus and "
+                                      "coverage bitmap to this directory")
+    parser.add_argument("--seed", type=int, help="random seed")
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+    cpu.load(args.program)
+    # the program ends at its last nonzero byte, the stack must stay above
+    code_end = len(cpu.ram.rstrip(b"\0"))
+
+    registers = parse_range(args.registers)
+    if args.data:
+        data = parse_range(args.data)
+    else:
+        data = range(code_end, 0xF4)
+    if not registers or registers.start < 0 or registers.stop > 8:
+        parser.error("--registers must be within 0-7")
+    if data.start < 0 or data.stop > 256:
+        parser.error("--data must be within 0x00-0xFF")
+
+    options = {"registers": registers, "data": data, "stack_floor": code_end,
+               "max_cycles": args.max_cycles}
+
+    def report(stats):
+        print(f"\r{stats['elapsed']:6.1f}s  {stats['execs']:10,d} execs  "
+              f"{stats['execs_per_sec']:8,.0f}/s  corpus {stats['corpus']:4d}  "
+              f"edges {stats['edges']:5d}  crashes {stats['crashes']:3d}",
+              end="", file=sys.stderr, flush=True)
+
+    corpus, bitmap, crashes, execs = fuzz_parallel(
+        cpu.snapshot(), options, args.time, args.jobs, args.seed, report)
+    print(file=sys.stderr)
+
+    for (pc, message), data_in in sorted(crashes.items()):
+        print(f"crash at {pc:02X}: {message}")
+        print(f"    {format_input(data_in, registers, data)}")
+
+    if args.out:
+        os.makedirs(os.path.join(args.out, "crashes"), exist_ok=True)
+        os.makedirs(os.path.join(args.out, "corpus"), exist_ok=True)
+        for i, ((pc, _), data_in) in enumerate(sorted(crashes.items())):
+            with open(os.path.join(args.out, "crashes",
+                                   f"crash-{pc:02x}-{i}.bin"), "wb") as f:
+                f.write(data_in)
+        for i, data_in in enumerate(corpus):
+            with open(os.path.join(args.out, "corpus", f"{i:06d}.bin"),
+                      "wb") as f:
+                f.write(data_in)
+        with open(os.path.join(args.out, "coverage.bin"), "wb") as f:
+            f.write(bitmap)
+
+    return 1 if crashes else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Binary LS-8 program images (.ls8b).
+
+An image is a small header followed by the raw program bytes and an optional
+symbol section:
+
+    magic "LS8B", version (1 byte), pad (1 byte),
+    code length (2 bytes), symbol count (2 bytes)      little endian
+    code length bytes of program
+    symbol count entries of: address (1 byte), name length (1 byte), name
+
+Usage: image.py infile.ls8 [outfile.ls8b]
+"""
+
+import importlib
+import mmap
+import os
+import re
+import struct
+import sys
+
+MAGIC = b"LS8B"
+VERSION = 1
+HEADER = struct.Struct("<4sBxHH")
+SYMBOL = struct.Struct("<BB")
+
+RAM_SIZE = 256
+
+# label comments written by asm.py, e.g. "# Loop (address 12):"
+LABEL_COMMENT = re.compile(r"#\s*(\w+) \(address (\d+)\):")
+
+
+def read_listing(filename):
+    """
+    Read an .ls8 text file. Returns the program bytes and a dict of the
+    labels asm.py recorded in its comments, name -> address.
+    """
+
+    program = bytearray()
+    symbols = {}
+
+    with open(filename) as f:
+        for line in f:
+            code, _, comment = line.partition('#')
+            code = code.strip()
+
+            if code != '':
+                # convert "binary" string into a number
+                program.append(int(code, 2))
+                if len(program) > RAM_SIZE:
+                    raise Exception("Out of memory. Program is too large.")
+            else:
+                m = LABEL_COMMENT.match('#' + comment)
+                if m is not None:
+                    symbols[m.group(1)] = int(m.group(2))
+
+    return bytes(program), symbols
+
+
+def pack_image(program, symbols=None):
+    """Return the .ls8b image for the given program bytes and symbols."""
+
+    if len(program) > RAM_SIZE:
+        raise Exception("Out of memory. Program is too large.")
+
+    symbols = symbols or {}
+    parts = [HEADER.pack(MAGIC, VERSION, len(program), len(symbols)),
+             bytes(program)]
+
+    for name, addr in symbols.items():
+        name = name.encode("ascii")
+        parts.append(SYMBOL.pack(addr, len(name)))
+        parts.append(name)
+
+    return b"".join(parts)
+
+
+def unpack_image(buf):
+    """
+    Split an image held in any buffer into a memoryview of the program and a
+    dict of symbols. The program is not copied.
+    """
+
+    buf = memoryview(buf)
+
+    if len(buf) < HEADER.size:
+        raise Exception("Not an LS-8 image: too short")
+
+    magic, version, length, count = HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise Exception("Not an LS-8 image: bad magic number")
+    if version != VERSION:
+        raise Exception(f"Unsupported LS-8 image version {version}")
+    if length > RAM_SIZE or HEADER.size + length > len(buf):
+        raise Exception("LS-8 image is truncated or too large")
+
+    program = buf[HEADER.size:HEADER.size + length]
+
+    symbols = {}
+    offset = HEADER.size + length
+    for _ in range(count):
+        addr, name_len = SYMBOL.unpack_from(buf, offset)
+        offset += SYMBOL.size
+        symbols[bytes(buf[offset:offset + name_len]).decode("ascii")] = addr
+        offset += name_len
+
+    return program, symbols
+
+
+def load_image(ram, source):
+    """
+    Copy an image into ram (a bytearray) and return its symbols.
+
+    source is a filename, which is memory-mapped, or anything supporting the
+    buffer protocol: bytes, bytearray, memoryview, mmap.
+    """
+
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return load_image(ram, m)
+
+    program, symbols = unpack_image(source)
+    length = len(program)
+
+    ram[:length] = program
+    ram[length:] = bytes(len(ram) - length)
+    program.release()
+
+    return symbols
+
+
+def convert(inputfile, outputfile):
+    """Convert an .ls8 text file into an .ls8b image."""
+
+    program, symbols = read_listing(inputfile)
+
+    with open(outputfile, "wb") as f:
+        f.write(pack_image(program, symbols))
+
+
+def import_sibling(directory, name):
+    """
+    Import a module from another top-level directory of the repository,
+    such as asm/asm.py from ls8 or this module from asm. The directories
+    aren't packages, so the other one is added to sys.path first.
+    """
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                        directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+    return importlib.import_module(name)
+
+
+def main(argv):
+    if len(argv) == 2:
+        inputfile = argv[1]
+        outputfile = inputfile[:-len(".ls8")] + ".ls8b" \
+            if inputfile.endswith(".ls8") else inputfile + ".ls8b"
+    elif len(argv) == 3:
+        inputfile, outputfile = argv[1], argv[2]
+    else:
+        print("usage: image.py infile.ls8 [outfile.ls8b]", file=sys.stderr)
+        return 1
+
+    convert(inputfile, outputfile)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,315 @@
+"""Run many LS-8 machines in lockstep with NumPy."""
+
+import numpy as np
+
+from cpu import CPU, IM, IS, SP, instr
+
+# machine status codes
+RUNNING = 0
+HALTED = 1
+ERROR = 2
+
+STATUS_NAMES = {RUNNING: "running", HALTED: "halted", ERROR: "error"}
+
+# index of the lowest set bit of every byte value (0 has none)
+LOWEST_BIT = np.array([(v & -v).bit_length() - 1 if v else 0
+                       for v in range(256)], dtype=np.intp)
+
+
+class Lockstep:
+    """
+    N LS-8 machines stepped together, one instruction at a time.
+
+    Machine state lives in NumPy arrays: `reg` is (N, 8), `ram` is (N, 256),
+    `pc` and `fl` are (N,). Every step fetches the instruction of each
+    running machine with one gather, then runs each distinct opcode once
+    over the machines that are executing it. Machines that branch somewhere
+    else simply end up in a different opcode group; machines that halt or
+    fail are masked out of later steps.
+
+    Registers are real 8-bit values, so results wrap at 256 as the spec
+    requires. There is no timer: only INT raises interrupts, which keeps
+    every machine deterministic.
+    """
+
+    def __init__(self, program, n):
+        self.n = n
+
+        self.reg = np.zeros((n, 8), dtype=np.uint8)
+        self.reg[:, IM] = 0b00000001
+        self.reg[:, SP] = 0xF4
+        self.pc = np.zeros(n, dtype=np.uint8)
+        self.fl = np.zeros(n, dtype=np.uint8)
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.ram[:, :len(program)] = program
+        # label name -> address, when the loaded program has them
+        self.symbols = {}
+
+        self.interrupts_enabled = np.ones(n, dtype=bool)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.status = np.full(n, RUNNING, dtype=np.uint8)
+        self.errors = [None] * n
+        self.output = [[] for _ in range(n)]
+
+        # opcode -> vectorized handler, resolved once like CPU.dispatch
+        self.handlers = {ir: getattr(self, name) for ir, name in instr.items()}
+
+    @classmethod
+    def load(cls, filename, n):
+        """Create n machines running the given .ls8 or .ls8b file."""
+
+        cpu = CPU()
+        cpu.load(filename)
+        machines = cls(cpu.ram, n)
+        machines.symbols = cpu.symbols
+        return machines
+
+    def fail(self, rows, message):
+        """Stop the given machines with an error message."""
+
+        self.status[rows] = ERROR
+        for row in rows:
+            self.errors[row] = message
+
+    def step(self):
+        """
+        Execute one instruction on every running machine. Returns False once
+        no machine is left running.
+        """
+
+        rows = np.flatnonzero(self.status == RUNNING)
+        if rows.size == 0:
+            return False
+
+        self.check_interrupts(rows)
+
+        pc = self.pc[rows].astype(np.intp)
+        ir = self.ram[rows, pc]
+        operand_a = self.ram[rows, (pc + 1) & 0xFF].astype(np.intp)
+        operand_b = self.ram[rows, (pc + 2) & 0xFF].astype(np.intp)
+        self.cycles[rows] += 1
+
+        for op in np.unique(ir).tolist():
+            sel = ir == op
+            r = rows[sel]
+            a = operand_a[sel]
+            b = operand_b[sel]
+
+            handler = self.handlers.get(op)
+            if handler is None:
+                self.fail(r, f"Invlaid instruction {op}. Terminating.")
+                continue
+
+            # every operand is a register number, except the value of LDI
+            num_operands = op >> 6
+            bad = np.zeros(r.size, dtype=bool)
+            if num_operands >= 1:
+                bad |= a > 7
+            if num_operands == 2 and instr[op] != "LDI":
+                bad |= b > 7
+            if bad.any():
+                self.fail(r[bad], f"Invalid register for {instr[op]}")
+                r, a, b, sel = r[~bad], a[~bad], b[~bad], sel.copy()
+                sel[sel] = ~bad
+
+            handler(r, a, b)
+
+            if not op >> 4 & 0b0001:
+                # machines that halted or failed keep their PC
+                live = self.status[r] == RUNNING
+                self.pc[r[live]] = (pc[sel][live] + num_operands + 1) & 0xFF
+
+        return True
+
+    def run(self, max_steps=None):
+        """
+        Step until every machine has halted or failed, or until max_steps
+        steps have run. Returns the per-machine results.
+        """
+
+        steps = 0
+        while self.step():
+            steps += 1
+            if max_steps is not None and steps >= max_steps:
+                break
+
+        return self.results()
+
+    def results(self):
+        """Return the final state and output of every machine as dicts."""
+
+        return [
+            {
+                "status": STATUS_NAMES[int(self.status[i])],
+                "error": self.errors[i],
+                "reg": self.reg[i].tolist(),
+                "pc": int(self.pc[i]),
+                "fl": int(self.fl[i]),
+                "ram": self.ram[i].tobytes(),
+                "cycles": int(self.cycles[i]),
+                "output": "".join(self.output[i]),
+            }
+            for i in range(self.n)
+        ]
+
+    def check_interrupts(self, rows):
+        """Vectorized CPU.check_interrupts for the given machines."""
+
+        masked = self.reg[rows, IM] & self.reg[rows, IS]
+        sel = (masked != 0) & self.interrupts_enabled[rows]
+        if not sel.any():
+            return
+
+        r = rows[sel]
+        i = LOWEST_BIT[masked[sel]]
+
+        self.interrupts_enabled[r] = False
+        self.reg[r, IS] ^= (1 << i).astype(np.uint8)
+
+        self.push(r, self.pc[r])
+        self.push(r, self.fl[r])
+        for n in range(7):
+            self.push(r, self.reg[r, n])
+
+        self.pc[r] = self.ram[r, 0xF8 + i]
+
+    def push(self, r, values):
+        self.reg[r, SP] -= 1
+        self.ram[r, self.reg[r, SP]] = values
+
+    def pop(self, r):
+        values = self.ram[r, self.reg[r, SP]]
+        self.reg[r, SP] += 1
+        return values
+
+    # Vectorized ALU instruction handlers
+    def ADD(self, r, a, b):
+        self.reg[r, a] += self.reg[r, b]
+
+    def AND(self, r, a, b):
+        self.reg[r, a] &= self.reg[r, b]
+
+    def CMP(self, r, a, b):
+        x = self.reg[r, a]
+        y = self.reg[r, b]
+        self.fl[r] = np.where(x == y, 1, np.where(x > y, 2, 4))
+
+    def DEC(self, r, a, b):
+        self.reg[r, a] -= 1
+
+    def DIV(self, r, a, b):
+        self.divide(r, a, b, np.floor_divide, "DIV: Division by zero")
+
+    def INC(self, r, a, b):
+        self.reg[r, a] += 1
+
+    def MOD(self, r, a, b):
+        self.divide(r, a, b, np.remainder, "MOD: Division by zero")
+
+    def MUL(self, r, a, b):
+        self.reg[r, a] *= self.reg[r, b]
+
+    def NOT(self, r, a, b):
+        self.reg[r, a] = ~self.reg[r, a]
+
+    def OR(self, r, a, b):
+        self.reg[r, a] |= self.reg[r, b]
+
+    def SHL(self, r, a, b):
+        shift = np.minimum(self.reg[r, b], 8).astype(np.uint16)
+        self.reg[r, a] = (self.reg[r, a].astype(np.uint16) << shift) & 0xFF
+
+    def SHR(self, r, a, b):
+        shift = np.minimum(self.reg[r, b], 8)
+        self.reg[r, a] = self.reg[r, a] >> shift
+
+    def SUB(self, r, a, b):
+        self.reg[r, a] -= self.reg[r, b]
+
+    def XOR(self, r, a, b):
+        self.reg[r, a] ^= self.reg[r, b]
+
+    def divide(self, r, a, b, func, message):
+        divisor = self.reg[r, b]
+        zero = divisor == 0
+        if zero.any():
+            self.fail(r[zero], message)
+            r, a, divisor = r[~zero], a[~zero], divisor[~zero]
+        self.reg[r, a] = func(self.reg[r, a], divisor)
+
+    # Vectorized non-ALU instruction handlers
+    def CALL(self, r, a, b):
+        self.push(r, (self.pc[r] + 2) & 0xFF)
+        self.pc[r] = self.reg[r, a]
+
+    def HLT(self, r, a, b):
+        self.status[r] = HALTED
+
+    def INT(self, r, a, b):
+        num = self.reg[r, a]
+        bad = num > 7
+        if bad.any():
+            self.fail(r[bad], "INT: Invalid interrupt provided")
+            r, num = r[~bad], num[~bad]
+        self.reg[r, IS] |= (1 << num.astype(np.intp)).astype(np.uint8)
+        self.pc[r] += 2
+
+    def IRET(self, r, a, b):
+        for n in range(6, -1, -1):
+            self.reg[r, n] = self.pop(r)
+        self.fl[r] = self.pop(r)
+        self.pc[r] = self.pop(r)
+        self.interrupts_enabled[r] = True
+
+    def JMP(self, r, a, b):
+        self.pc[r] = self.reg[r, a]
+
+    def LDI(self, r, a, b):
+        self.reg[r, a] = b
+
+    def NOP(self, r, a, b):
+        pass
+
+    def POP(self, r, a, b):
+        self.reg[r, a] = self.pop(r)
+
+    def PRA(self, r, a, b):
+        for row, value in zip(r.tolist(), self.reg[r, a].tolist()):
+            self.output[row].append(chr(value))
+
+    def PRN(self, r, a, b):
+        for row, value in zip(r.tolist(), self.reg[r, a].tolist()):
+            self.output[row].append(f"{value}\n")
+
+    def PUSH(self, r, a, b):
+        self.push(r, self.reg[r, a])
+
+    def RET(self, r, a, b):
+        self.pc[r] = self.pop(r)
+
+    def ST(self, r, a, b):
+        self.ram[r, self.reg[r, a]] = self.reg[r, b]
+
+    def not_implemented(self, r, a, b, name):
+        self.fail(r, f"Instruction not yet implemented: {name}")
+
+    def JEQ(self, r, a, b):
+        self.not_implemented(r, a, b, "JEQ")
+
+    def JGE(self, r, a, b):
+        self.not_implemented(r, a, b, "JGE")
+
+    def JGT(self, r, a, b):
+        self.not_implemented(r, a, b, "JGT")
+
+    def JLE(self, r, a, b):
+        self.not_implemented(r, a, b, "JLE")
+
+    def JLT(self, r, a, b):
+        self.not_implemented(r, a, b, "JLT")
+
+    def JNE(self, r, a, b):
+        self.not_implemented(r, a, b, "JNE")
+
+    def LD(self, r, a, b):
+        self.reg[r, a] = self.ram[r, self.reg[r, b]]
@@ -2,10 +2,90 @@
 
 """Main."""
 
+import argparse
+import signal
 import sys
 from cpu import *
+from engines import ENGINES, EXACT, TOOLS, conform, engine_class
+from replay import EventLog, read_events, record, replay
 
-cpu = CPU()
+parser = argparse.ArgumentParser(description="Run an LS-8 program.")
+parser.add_argument("program", help=".ls8 or .ls8b file")
+parser.add_argument("--clock", type=float,
+                    help="run at this many instructions per second, e.g. 1e6 "
+                         "(default: as fast as possible)")
+parser.add_argument("--no-throttle", action="store_true",
+                    help="with --clock, time the timer interrupt by the "
+                         "clock rate but don't slow down to it")
+parser.add_argument("--busy-wait", action="store_true",
+                    help="execute idle loops instead of fast-forwarding "
+                         "through them to the next interrupt")
+parser.add_argument("--engine", choices=list(ENGINES), default="cpu",
+                    help="execution engine (default cpu); traced and "
+                         "profiled only with --conform, tracer.py and "
+                         "profiler.py run programs on them")
+parser.add_argument("--conform", metavar="ENGINE", choices=list(EXACT),
+                    help="instead of running normally, run the program on "
+                         "--engine and ENGINE in lockstep and report the "
+                         "first place they differ")
+parser.add_argument("--max-cycles", type=int,
+                    help="stop after this many instructions (with --conform, "
+                         "default 1000000)")
+parser.add_argument("--record", metavar="FILE",
+                    help="log the timer and keyboard interrupts to FILE")
+parser.add_argument("--replay", metavar="FILE",
+                    help="take the timer and keyboard interrupts from a log "
+                         "written by --record, and stop where it ended")
+args = parser.parse_args()
+if args.engine in TOOLS and not args.conform:
+    parser.error(f"the {args.engine} engine's results are written by "
+                 f"{TOOLS[args.engine]}, run the program with that")
 
-cpu.load()
-cpu.run()
\ No newline at end of file
+if args.conform:
+    a = engine_class(args.conform)()
+    b = engine_class(args.engine)()
+    a.load(args.program)
+    b.load(args.program)
+
+    divergence = conform(a, b, args.max_cycles or 1_000_000)
+    if divergence is None:
+        print(f"{args.engine} and {args.conform} agree for {b.cycles} "
+              "instructions")
+        sys.exit(0)
+
+    print(f"{args.engine} and {args.conform} diverge after "
+          f"{divergence['cycles']} instructions, stepping from "
+          f"PC {divergence['pc']:02X}: {divergence['instruction']}")
+    for difference in divergence["differences"]:
+        print(f"    {difference}")
+    sys.exit(1)
+
+cpu = engine_class(args.engine)()
+
+cpu.load(args.program)
+cpu.set_clock(args.clock, throttle=not args.no_throttle)
+if args.busy_wait:
+    # engines that count every instruction never skip idle loops anyway
+    cpu.skip_idle = False
+
+if args.replay:
+    cycles, events = read_events(args.replay)
+    replay(cpu, events)
+    cpu.run(max_cycles=cycles if args.max_cycles is None else args.max_cycles)
+    sys.exit(0)
+
+# stop through the usual exit path on SIGTERM, so buffered output is written
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+# keys typed or piped in raise the keyboard interrupt
+keyboard = cpu.attach_keyboard()
+log = None
+if args.record:
+    log = EventLog()
+    record(cpu, log)
+try:
+    cpu.run(max_cycles=args.max_cycles)
+finally:
+    keyboard.close()
+    if log is not None:
+        log.save(args.record, cpu.cycles)
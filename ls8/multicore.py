@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+
+"""
+Multi-core LS-8: several cores, each in its own process, sharing one RAM.
+
+Usage: multicore.py program.ls8 [--cores N] [--sync N] [--max-cycles N]
+                    [--timeout SECONDS] [--clock HZ]
+
+The 256 bytes of RAM live in multiprocessing.shared_memory, so every
+core's loads, stores and instruction fetches see the same memory while
+the cores run in parallel on the host. Registers, PC and FL are private to
+each core. All cores start at address 0 with the same program; a program
+tells them apart through the reserved addresses below the interrupt
+vectors:
+
+    LD from 0xF5 (CORE_ID_ADDR)  this core's number, 0 to cores - 1
+    LD from 0xF6 (CORES_ADDR)    the number of cores
+    ST to 0xF7 (IPI_ADDR)        interrupt core (value >> 3) with
+                                 interrupt (value & 7), setting that bit
+                                 in its IS register
+
+The STACK_AREA bytes below 0xF4 (0x74-0xF3) are reserved for stacks and
+shared out evenly between the cores, so with N cores each one has
+STACK_AREA // N bytes: core 0 starts at the usual 0xF4 and each other core
+that many bytes below the previous one. The program and its data should fit
+below 0x74. At least MIN_STACK bytes per core, room for an interrupt and a
+call, limits a machine to MAX_CORES cores.
+
+By default the cores run freely and an inter-core interrupt reaches its
+target the next time that core polls its devices, or straight away if it
+is waiting in an idle loop. With sync=N the cores meet at a barrier every
+N instructions, and inter-core interrupts and the end of the run are only
+dealt with there; the timers run on emulated time. Runs are then
+repeatable as long as the cores don't race on the same RAM within one
+N-instruction step.
+"""
+
+import argparse
+import io
+import math
+import multiprocessing
+import queue
+import sys
+import time
+from multiprocessing import shared_memory
+
+from cpu import *
+
+RAM_SIZE = 256
+
+CORE_ID_ADDR = 0xF5
+CORES_ADDR = 0xF6
+IPI_ADDR = 0xF7
+
+# stack bytes below 0xF4 shared out between the cores, and the least any
+# core gets: an interrupt pushes 9 bytes and a call one more
+STACK_AREA = 128
+MIN_STACK = 10
+MAX_CORES = STACK_AREA // MIN_STACK
+
+# instructions a free-running core runs between checks on the other cores
+SLICE = 65536
+
+# seconds past the cores' own timeout, spawning included, that the parent
+# waits for them to report, that it gives a core which exited to get its
+# result through the queue, and between its checks on the cores
+REPORT_GRACE = 10.0
+EXIT_GRACE = 1.0
+CHECK_INTERVAL = 0.1
+
+# a core's state in the shared status bytes
+RUNNING = 0
+DONE = 1
+WAITING = 2     # idle until another core interrupts it
+
+
+def stack_size(cores):
+    """Bytes of stack each core gets on a machine with this many cores."""
+    return STACK_AREA // cores
+
+
+class CoreCPU(CPU):
+    """
+    One core of a multi-core machine. memory is the shared buffer holding
+    the RAM, then one mailbox byte per core of interrupts sent to it, then
+    one status byte per core.
+    """
+
+    def __init__(self, core_id, cores, memory, lock, wakeups):
+        super().__init__()
+        self.core_id = core_id
+        self.cores = cores
+        self.ram = memory[:RAM_SIZE]
+        self.mailboxes = memory[RAM_SIZE:RAM_SIZE + cores]
+        self.status = memory[RAM_SIZE + cores:RAM_SIZE + 2 * cores]
+        self.lock = lock
+        self.wakeups = wakeups
+
+        self.reg[SP] = 0xF4 - core_id * stack_size(cores)
+
+    def release(self):
+        """Let go of the shared memory so it can be closed."""
+
+        self.ram.release()
+        self.mailboxes.release()
+        self.status.release()
+
+    def ram_read(self, addr):
+        if addr == CORE_ID_ADDR:
+            return self.core_id
+        if addr == CORES_ADDR:
+            return self.cores
+        return super().ram_read(addr)
+
+    def ram_write(self, val, addr):
+        if addr == IPI_ADDR:
+            self.send_interrupt(val >> 3, val & 0b111)
+        super().ram_write(val, addr)
+
+    def send_interrupt(self, core, num):
+        """Set bit num of core's IS register the next time it picks it up."""
+
+        if core >= self.cores:
+            raise Exception(f"No core {core} to interrupt")
+
+        with self.lock:
+            # a core that has stopped never takes it
+            if self.status[core] == DONE:
+                return
+            self.mailboxes[core] |= 1 << num
+        self.wakeups[core].set()
+
+    def take_interrupts(self):
+        """Move the interrupts sent to this core into IS."""
+
+        if self.mailboxes[self.core_id]:
+            with self.lock:
+                sent = self.mailboxes[self.core_id]
+                self.mailboxes[self.core_id] = 0
+            self.reg[IS] |= sent
+            self.interrupts.update()
+            self.status[self.core_id] = RUNNING
+
+    def finish(self):
+        """Mark the core DONE, dropping the interrupts it will never take."""
+
+        with self.lock:
+            self.status[self.core_id] = DONE
+            self.mailboxes[self.core_id] = 0
+
+    def others_running(self):
+        """True if another core may still send this one an interrupt."""
+
+        for core in range(self.cores):
+            if core == self.core_id:
+                continue
+            status = self.status[core]
+            # a waiting core with mail is about to run again
+            if status == RUNNING or (status == WAITING
+                                     and self.mailboxes[core]):
+                return True
+        return False
+
+    def waiting(self):
+        """
+        True if the core is in an idle loop that only an inter-core
+        interrupt can end.
+        """
+
+        return (self.interrupts_enabled and not self.interrupts.pending
+                and not self.reg[IM] & 0b00000001
+                and not self.mailboxes[self.core_id]
+                and self.idle_loop() != 0)
+
+
+class InterCoreInterrupts:
+    """Device handing a core the interrupts other cores send it."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.wakeup = cpu.wakeups[cpu.core_id]
+
+    def poll(self, cpu):
+        cpu.take_interrupts()
+
+    def listening(self, cpu):
+        # only a running core can still send something
+        return bool(cpu.reg[IM]) and cpu.others_running()
+
+    def wait(self, timeout=None):
+        cpu = self.cpu
+        self.wakeup.clear()
+        # a core only another core can wake stays WAITING until one does,
+        # see take_interrupts(), and once every core is waiting like that
+        # none of them waits any longer
+        if cpu.waiting():
+            cpu.status[cpu.core_id] = WAITING
+        if cpu.mailboxes[cpu.core_id] or not cpu.others_running():
+            return
+        self.wakeup.wait(timeout)
+
+
+def core_result(cpu, reason):
+    return {
+        "core": cpu.core_id,
+        "reason": reason,
+        "cycles": cpu.cycles,
+        "pc": cpu.pc,
+        "fl": cpu.fl,
+        "reg": list(cpu.reg),
+        "output": cpu.output.writer.getvalue().decode("latin-1"),
+    }
+
+
+def lost_result(core, reason):
+    """The result of a core that never reported its own."""
+
+    return {"core": core, "reason": reason, "cycles": None, "pc": None,
+            "fl": None, "reg": None, "output": ""}
+
+
+def run_core(core_id, cores, name, lock, wakeups, barrier, options, results):
+    """Process body for one core."""
+
+    memory = shared_memory.SharedMemory(name)
+    cpu = CoreCPU(core_id, cores, memory.buf, lock, wakeups)
+    cpu.set_output(OutputDevice(io.BytesIO()))
+
+    max_cycles = options["max_cycles"]
+    sync = options["sync"]
+    if sync:
+        cpu.set_clock(options["clock"] or 1_000_000, throttle=False)
+    else:
+        cpu.set_clock(options["clock"])
+        cpu.devices.append(InterCoreInterrupts(cpu))
+
+    try:
+        if sync:
+            reason = run_synced(cpu, sync, max_cycles, barrier)
+        else:
+            reason = run_free(cpu, max_cycles, options["timeout"])
+    except Exception as e:
+        reason = f"error: {e}"
+    finally:
+        cpu.finish()
+        # wake anyone waiting for this core
+        for wakeup in wakeups:
+            wakeup.set()
+
+    results.put(core_result(cpu, reason))
+
+    cpu.release()
+    memory.close()
+
+
+def run_free(cpu, max_cycles, timeout):
+    """Run a core flat out until it halts, hits a limit or can't go on."""
+
+    limit = math.inf if max_cycles is None else max_cycles
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    while True:
+        remaining = None
+        if deadline is not None:
+            remaining = max(0.0, deadline - time.monotonic())
+        reason = cpu.run(max_cycles=min(SLICE, limit - cpu.cycles),
+                         timeout=remaining)
+
+        if reason != "max_cycles" or cpu.cycles >= limit:
+            return reason
+        if not cpu.others_running() and cpu.waiting():
+            return "idle"
+
+
+def run_synced(cpu, sync, max_cycles, barrier):
+    """Run a core in steps of sync instructions, in step with the others."""
+
+    limit = math.inf if max_cycles is None else max_cycles
+    reason = None
+
+    while True:
+        if reason is None:
+            try:
+                stopped = cpu.run(max_cycles=min(sync, limit - cpu.cycles))
+            except Exception as e:
+                stopped = f"error: {e}"
+            if stopped != "max_cycles" or cpu.cycles >= limit:
+                reason = stopped
+
+        # every core has finished the step, so every interrupt sent during
+        # it is in the mailboxes
+        barrier.wait()
+
+        if reason is not None:
+            cpu.finish()
+        else:
+            cpu.take_interrupts()
+            cpu.status[cpu.core_id] = WAITING if cpu.waiting() else RUNNING
+
+        # every core has said whether it can go on
+        barrier.wait()
+
+        if all(status != RUNNING for status in cpu.status):
+            return reason or "idle"
+
+
+class MultiCore:
+    """
+    A multi-core LS-8. Load a program, then run() it on every core:
+
+        with MultiCore(cores=4) as machine:
+            machine.load("program.ls8")
+            for result in machine.run(max_cycles=1_000_000):
+                print(result["core"], result["reason"], result["output"])
+    """
+
+    def __init__(self, cores=2):
+        if not 1 <= cores <= MAX_CORES:
+            raise ValueError(f"cores must be between 1 and {MAX_CORES}")
+
+        self.cores = cores
+        self.memory = shared_memory.SharedMemory(create=True,
+                                                 size=RAM_SIZE + 2 * cores)
+        self.memory.buf[:] = bytes(len(self.memory.buf))
+        self.ram = self.memory.buf[:RAM_SIZE]
+
+    def load(self, filename):
+        """Load an .ls8 or .ls8b program into the shared RAM."""
+
+        cpu = CPU()
+        cpu.load(filename)
+        self.ram[:] = cpu.ram
+
+    def run(self, max_cycles=None, timeout=None, sync=None, clock=None):
+        """
+        Run every core until they have all stopped. max_cycles and timeout
+        apply to each core. sync is the number of instructions between
+        barriers (None to run freely) and clock an instructions per second
+        rate as for CPU.set_clock().
+
+        Returns one result per core, in core order: why it stopped, its
+        instruction count, PC, FL, registers and output. A core that dies
+        without reporting, or hasn't reported REPORT_GRACE seconds after
+        its timeout, gets an "error: ..." reason and None for its state.
+        """
+
+        context = multiprocessing.get_context("spawn")
+        lock = context.Lock()
+        wakeups = [context.Event() for _ in range(self.cores)]
+        barrier = context.Barrier(self.cores)
+        results = context.Queue()
+        options = {"max_cycles": max_cycles, "timeout": timeout, "sync": sync,
+                   "clock": clock}
+
+        # clear the mailboxes and status bytes from any earlier run
+        self.memory.buf[RAM_SIZE:] = bytes(2 * self.cores)
+
+        processes = [
+            context.Process(target=run_core,
+                            args=(core, self.cores, self.memory.name, lock,
+                                  wakeups, barrier, options, results))
+            for core in range(self.cores)]
+        for process in processes:
+            process.start()
+
+        try:
+            return self.collect(processes, results, timeout)
+        finally:
+            for process in processes:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+
+    def collect(self, processes, results, timeout):
+        """Gather a result for every core, see run()."""
+
+        deadline = math.inf
+        if timeout is not None:
+            deadline = time.monotonic() + timeout + REPORT_GRACE
+        collected = {}
+        exited = {}     # core -> when its process was first seen gone
+
+        while len(collected) < len(processes):
+            try:
+                result = results.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                pass
+            else:
+                collected[result["core"]] = result
+                continue
+
+            now = time.monotonic()
+            for core, process in enumerate(processes):
+                if core in collected:
+                    continue
+                if now >= deadline:
+                    collected[core] = lost_result(core,
+                                                  "error: stopped responding")
+                elif not process.is_alive():
+                    # its result may still be on the way
+                    if now - exited.setdefault(core, now) >= EXIT_GRACE:
+                        collected[core] = lost_result(
+                            core, f"error: exited with code {process.exitcode}")
+
+        return [collected[core] for core in range(len(processes))]
+
+    def close(self):
+        self.ram.release()
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run an LS-8 program on several cores sharing RAM.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("--cores", type=int, default=2,
+                        help=f"number of cores, up to {MAX_CORES} (default 2)")
+    parser.add_argument("--sync", type=int, metavar="N",
+                        help="meet at a barrier every N instructions, for "
+                             "repeatable runs")
+    parser.add_argument("--max-cycles", type=int,
+                        help="stop each core after this many instructions")
+    parser.add_argument("--timeout", type=float,
+                        help="stop each core after this many seconds")
+    parser.add_argument("--clock", type=float,
+                        help="instructions per second for the timers")
+    args = parser.parse_args(argv[1:])
+    if not 1 <= args.cores <= MAX_CORES:
+        parser.error(f"--cores must be between 1 and {MAX_CORES}")
+
+    with MultiCore(args.cores) as machine:
+        machine.load(args.program)
+        results = machine.run(args.max_cycles, args.timeout, args.sync,
+                              args.clock)
+
+    for result in results:
+        sys.stdout.write(result["output"])
+        if result["cycles"] is None:
+            print(f"core {result['core']}: {result['reason']}",
+                  file=sys.stderr)
+        else:
+            print(f"core {result['core']}: {result['reason']} after "
+                  f"{result['cycles']} instructions", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+Per-opcode and per-PC execution profiler for the LS-8.
+
+Usage: profiler.py program.ls8 [--json out.json] [--collapsed out.folded]
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from cpu import *
+
+CALL = 0b01010000
+RET = 0b00010001
+IRET = 0b00010011
+
+
+class Profile:
+    """Counts collected by ProfilingCPU."""
+
+    def __init__(self):
+        self.opcodes = [0] * 256        # retired instructions per opcode
+        self.pcs = [0] * 256            # retired instructions per address
+        self.calls = {}                 # subroutine address -> entries
+        self.inclusive = {}             # subroutine address -> instructions
+        self.interrupts = {}            # interrupt number -> stats dict
+        self.stacks = {}                # frame names tuple -> instructions
+        self.max_stack_depth = 0        # bytes below the empty stack (0xF4)
+
+    def to_dict(self, symbols=None):
+        """Return the profile as a JSON-ready dict."""
+
+        names = frame_names(symbols)
+
+        return {
+            "instructions": sum(self.opcodes),
+            "opcodes": {instr.get(ir, f"0x{ir:02X}"): n
+                        for ir, n in enumerate(self.opcodes) if n},
+            "pcs": {f"0x{pc:02X}": n for pc, n in enumerate(self.pcs) if n},
+            "subroutines": {
+                names(addr): {"calls": n,
+                              "inclusive_instructions": self.inclusive.get(addr, 0)}
+                for addr, n in self.calls.items()
+            },
+            "interrupts": {str(i): stats
+                           for i, stats in self.interrupts.items()},
+            "max_stack_depth": self.max_stack_depth,
+        }
+
+    def to_json(self, symbols=None):
+        return json.dumps(self.to_dict(symbols), indent=2)
+
+    def collapsed(self):
+        """
+        Return the instruction counts per call stack in the collapsed-stack
+        format flamegraph tools read: "main;frame;frame count" per line.
+        """
+
+        return "".join(f"{';'.join(stack)} {n}\n"
+                       for stack, n in sorted(self.stacks.items()) if n)
+
+
+def frame_names(symbols):
+    """Return a function naming a subroutine address, by label if known."""
+
+    by_addr = {addr: name for name, addr in (symbols or {}).items()}
+
+    def name(addr):
+        return by_addr.get(addr, f"0x{addr:02X}")
+
+    return name
+
+
+class ProfilingCPU(CPU):
+    """
+    CPU whose run() counts where instructions go.
+
+    The instrumented loop only exists here, so CPU.run() pays nothing when
+    profiling is off. Per-instruction work is limited to the opcode and PC
+    counters and the stack-depth check; call stacks and interrupt handlers
+    are accounted for only when they are entered and left.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.profile = Profile()
+        # idle loops count towards the profile like everything else
+        self.skip_idle = False
+
+    def run(self, max_cycles=None, timeout=None):
+        """Run the CPU like CPU.run(), collecting a profile as it goes."""
+
+        pc, cycles, next_poll = self.start_run(max_cycles, timeout)
+
+        profile = self.profile
+        opcodes = profile.opcodes
+        pcs = profile.pcs
+        stacks = profile.stacks
+        name = frame_names(self.symbols)
+
+        ram = self.ram
+        reg = self.reg
+        execute = self.execute
+        interrupts = self.interrupts
+        low_sp = reg[SP]
+
+        # shadow call stack of (kind, address or interrupt number,
+        # cycles on entry, perf_counter on entry)
+        frames = []
+        stack = ("main",)
+        stack_since = cycles
+
+        def enter(kind, key, frame):
+            nonlocal stack, stack_since
+            stacks[stack] = stacks.get(stack, 0) + cycles - stack_since
+            frames.append((kind, key, cycles, time.perf_counter()))
+            stack = stack + (frame,)
+            stack_since = cycles
+
+        def leave(kind):
+            nonlocal stack, stack_since
+            if not frames or frames[-1][0] != kind:
+                # RET/IRET without a matching entry we saw, leave it be
+                return None
+            stacks[stack] = stacks.get(stack, 0) + cycles - stack_since
+            stack = stack[:-1]
+            stack_since = cycles
+            return frames.pop()
+
+        try:
+            while True:
+                if cycles >= next_poll:
+                    stopped, cycles, next_poll = self.poll_point(pc, cycles)
+                    if stopped:
+                        return stopped
+
+                if interrupts.pending:
+                    masked = interrupts.pending
+                    num = (masked & -masked).bit_length() - 1
+                    pc = self.interrupt_point(pc)
+                    enter("int", num, f"I{num}")
+                    stats = profile.interrupts.setdefault(
+                        num, {"count": 0, "instructions": 0, "seconds": 0.0})
+                    stats["count"] += 1
+
+                ir = ram[pc]
+                cycles += 1
+                opcodes[ir] += 1
+                pcs[pc] += 1
+                pc = execute(pc)
+
+                if ir == CALL:
+                    profile.calls[pc] = profile.calls.get(pc, 0) + 1
+                    enter("call", pc, name(pc))
+                elif ir == RET:
+                    frame = leave("call")
+                    if frame is not None:
+                        addr = frame[1]
+                        profile.inclusive[addr] = (
+                            profile.inclusive.get(addr, 0) + cycles - frame[2])
+                elif ir == IRET:
+                    frame = leave("int")
+                    if frame is not None:
+                        stats = profile.interrupts[frame[1]]
+                        stats["instructions"] += cycles - frame[2]
+                        stats["seconds"] += time.perf_counter() - frame[3]
+
+                if reg[SP] < low_sp:
+                    low_sp = reg[SP]
+        except Halted:
+            return "halted"
+        finally:
+            self.end_run(pc, cycles)
+            stacks[stack] = stacks.get(stack, 0) + cycles - stack_since
+            profile.max_stack_depth = max(profile.max_stack_depth,
+                                          0xF4 - low_sp)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run an LS-8 program and report where its cycles go.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("--json", help="write the profile as JSON here")
+    parser.add_argument("--collapsed",
+                        help="write collapsed stacks for flamegraph tools here")
+    parser.add_argument("--max-cycles", type=int,
+                        help="stop after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    cpu = ProfilingCPU()
+    cpu.load(args.program)
+    cpu.run(max_cycles=args.max_cycles)
+
+    report = cpu.profile.to_json(cpu.symbols)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report, file=sys.stderr)
+
+    if args.collapsed:
+        with open(args.collapsed, "w") as f:
+            f.write(cpu.profile.collapsed())
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Deterministic record and replay of external interrupts for the LS-8.
+
+Usage: replay.py events.bin
+
+Recording logs every interrupt the timer and keyboard deliver, with the
+instruction count it was delivered at and, for the keyboard, the key
+written to 0xF4. Replaying delivers the same interrupts at exactly the same
+instruction counts instead of running the timer and reading the keyboard,
+so an interrupt-driven program repeats a recorded run instruction for
+instruction, at full speed and without reading the clock. Interrupts the
+program raises itself with INT happen the same way in both runs and aren't
+logged.
+
+From ls8.py:
+
+    python3 ls8.py --record events.bin examples/keyboard.ls8
+    python3 ls8.py --replay events.bin examples/keyboard.ls8
+
+From a script:
+
+    log = EventLog()
+    record(cpu, log)
+    cpu.run()
+    log.save("events.bin", cpu.cycles)
+
+    cycles, events = read_events("events.bin")
+    replay(other_cpu, events)
+    other_cpu.run(max_cycles=cycles)
+
+Replaying is exact on engines that stop at a given instruction count; the
+block engine delivers each interrupt at the end of the block that reaches
+its count.
+"""
+
+import math
+import struct
+import sys
+
+from cpu import *
+
+# One record per delivered interrupt: instruction count, interrupt number
+# and the key for keyboard interrupts (0 otherwise)
+EVENT = struct.Struct("<QBB")
+
+# Event logs are a magic number, version, record size and the instruction
+# count the recording ended at, then records
+EVENTS_MAGIC = b"LS8E"
+EVENTS_VERSION = 1
+EVENTS_HEADER = struct.Struct("<4sBBQ")
+
+TIMER = 0
+KEYBOARD = 1
+
+
+class EventLog:
+    """Binary log of delivered interrupts, built up in memory."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def record(self, cycles, num, key=0):
+        self.buffer += EVENT.pack(cycles, num, key)
+
+    def count(self):
+        """Number of interrupts recorded so far."""
+        return len(self.buffer) // EVENT.size
+
+    def save(self, filename, cycles):
+        """Write the log to an event file for a run that ended at cycles."""
+
+        with open(filename, "wb") as f:
+            f.write(EVENTS_HEADER.pack(EVENTS_MAGIC, EVENTS_VERSION,
+                                       EVENT.size, cycles))
+            f.write(self.buffer)
+
+
+def read_events(filename):
+    """
+    Read an event file. Returns the instruction count the recording ended
+    at and a list of (cycles, num, key) tuples.
+    """
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    if len(data) < EVENTS_HEADER.size:
+        raise Exception(f"{filename}: not an LS-8 event log")
+    magic, version, size, cycles = EVENTS_HEADER.unpack_from(data)
+    if (magic != EVENTS_MAGIC or version != EVENTS_VERSION
+            or size != EVENT.size):
+        raise Exception(f"{filename}: not an LS-8 event log")
+
+    body = memoryview(data)[EVENTS_HEADER.size:]
+    if len(body) % EVENT.size:
+        raise Exception(f"{filename}: event log is truncated")
+
+    return cycles, list(EVENT.iter_unpack(body))
+
+
+class RecordingDevice:
+    """
+    Wraps a device that raises one interrupt and logs each time it does.
+
+    An interrupt whose bit was already set in IS adds nothing to the run, so
+    only new ones are logged.
+    """
+
+    def __init__(self, device, num, log):
+        self.device = device
+        self.num = num
+        self.log = log
+
+    def __getattr__(self, name):
+        # due(), wake_time() and the like are the wrapped device's
+        return getattr(self.device, name)
+
+    def poll(self, cpu):
+        before = cpu.reg[IS]
+        self.device.poll(cpu)
+        if cpu.reg[IS] & ~before & (1 << self.num):
+            key = cpu.ram[Keyboard.KEY_ADDR] if self.num == KEYBOARD else 0
+            self.log.record(cpu.cycles, self.num, key)
+
+
+class ReplayDevice:
+    """Delivers logged interrupts at the instruction counts they were logged at."""
+
+    def __init__(self, events):
+        self.events = events
+        self.index = 0          # next event to deliver
+
+    def due(self, cpu):
+        if self.index < len(self.events):
+            return self.events[self.index][0]
+        return math.inf
+
+    def done(self):
+        """True once every logged interrupt has been delivered."""
+        return self.index == len(self.events)
+
+    def poll(self, cpu):
+        events = self.events
+        while self.index < len(events) and events[self.index][0] <= cpu.cycles:
+            _, num, key = events[self.index]
+            if num == KEYBOARD:
+                cpu.ram_write(key, Keyboard.KEY_ADDR)
+            cpu.interrupts.raise_interrupt(num)
+            self.index += 1
+
+
+def record(cpu, log):
+    """
+    Log the interrupts cpu's timer and keyboard deliver from now on to log.
+
+    Keys are then only handed over when the CPU polls its devices, not
+    straight after IRET, so every delivery happens at a known instruction
+    count.
+    """
+
+    devices = cpu.devices
+    devices[devices.index(cpu.timer)] = RecordingDevice(cpu.timer, TIMER, log)
+    if cpu.keyboard is not None:
+        devices[devices.index(cpu.keyboard)] = RecordingDevice(
+            cpu.keyboard, KEYBOARD, log)
+        cpu.keyboard = None
+
+
+def replay(cpu, events):
+    """
+    Deliver logged events to cpu in place of its timer and keyboard.
+    Returns the ReplayDevice.
+    """
+
+    device = ReplayDevice(events)
+    cpu.devices.remove(cpu.timer)
+    if cpu.keyboard is not None:
+        cpu.devices.remove(cpu.keyboard)
+        cpu.keyboard = None
+    cpu.devices.append(device)
+    cpu.schedule()
+
+    return device
+
+
+def main(argv):
+    if len(argv) != 2:
+        print("usage: replay.py events.bin", file=sys.stderr)
+        return 1
+
+    end, events = read_events(argv[1])
+    for cycles, num, key in events:
+        if num == KEYBOARD:
+            print(f"{cycles:12d}  I{num}  key {key:02X}")
+        else:
+            print(f"{cycles:12d}  I{num}")
+    print(f"{end:12d}  end")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+
+"""
+Local job server for LS-8 programs.
+
+Usage:
+    server.py serve [--socket PATH | --port N] [-j JOBS] [--max-pending N]
+    server.py submit [--socket PATH | --port N] program [--max-cycles N]
+                     [--timeout SECONDS]
+
+Clients send one JSON request per line and get JSON lines back. A job is
+either assembly source or a base64 .ls8b image:
+
+    {"op": "run", "id": "a", "source": "LDI R0,8\\nPRN R0\\nHLT\\n",
+     "max_cycles": 100000, "timeout": 5}
+      -> {"id": "a", "event": "queued"}
+      -> {"id": "a", "event": "started", "queue_wait": 0.0004}
+      -> {"id": "a", "event": "output", "data": "8\\n"}       (any number)
+      -> {"id": "a", "event": "done", "exit": "halted", "error": null,
+          "cycles": 3, "pc": 5, "fl": 0, "reg": [...], "elapsed": 0.0002}
+
+    {"op": "cancel", "id": "a"}
+      -> {"id": "a", "event": "cancelling"}
+         and the job finishes with exit "cancelled"
+    {"op": "stats"}                 -> {"event": "stats", ...}
+
+Jobs run on a pool of long-lived worker processes, so each one skips
+interpreter startup and imports, and workers keep their assembly cache warm.
+At most max-pending jobs are queued or running at once. While the server is
+full it stops reading "run" requests, which pushes back on the client.
+Cancel requests for a blocked connection can be sent on another one.
+"""
+
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import signal
+import statistics
+import sys
+import threading
+import time
+
+import image
+from cpu import *
+
+# instructions run between checks for cancellation; output is also streamed
+# back to the client after each slice
+SLICE = 65536
+
+# latencies kept for the stats, most recent first out
+LATENCY_WINDOW = 1000
+
+# set in each worker process by init_worker()
+worker_events = None
+worker_cancel = None
+
+
+class EventWriter:
+    """OutputDevice writer that sends a job's output to the server."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def write(self, data):
+        worker_events.put((self.job_id, "output", data))
+
+    def flush(self):
+        pass
+
+
+def init_worker(events, cancel):
+    global worker_events, worker_cancel
+    worker_events = events
+    worker_cancel = cancel
+
+
+def run_sliced(cpu, slot, max_cycles=None, timeout=None):
+    """
+    Run the CPU SLICE instructions at a time, stopping early if the server
+    sets the job's cancel flag. Returns why the CPU stopped.
+    """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    remaining = max_cycles
+
+    while True:
+        if worker_cancel[slot]:
+            return "cancelled"
+
+        budget = SLICE if remaining is None else min(SLICE, remaining)
+        left = None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        reason = cpu.run(max_cycles=budget, timeout=left)
+        if reason != "max_cycles":
+            return reason
+
+        if remaining is not None:
+            remaining -= budget
+            if remaining <= 0:
+                return "max_cycles"
+
+
+def run_job(job_id, slot, kind, program, max_cycles=None, timeout=None):
+    """
+    Worker side of a job: load the program, run it and report the final
+    state. Output and the result go back through the events queue, in order.
+    """
+
+    worker_events.put((job_id, "started", time.monotonic()))
+
+    cpu = CPU()
+    cpu.set_output(OutputDevice(EventWriter(job_id)))
+    error = None
+
+    start = time.perf_counter()
+    try:
+        if kind == "source":
+            cpu.load_asm(program)
+        else:
+            cpu.load_image(program)
+
+        reason = run_sliced(cpu, slot, max_cycles, timeout)
+    except Exception as e:
+        reason = "error"
+        error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+
+    cpu.output.flush()
+    worker_events.put((job_id, "done", {
+        "exit": reason,
+        "error": error,
+        "cycles": cpu.cycles,
+        "pc": cpu.pc,
+        "fl": cpu.fl,
+        "reg": list(cpu.reg),
+        "elapsed": elapsed,
+    }))
+
+
+class Job:
+    """Server side bookkeeping for one job."""
+
+    def __init__(self, job_id, conn, slot):
+        self.id = job_id
+        self.conn = conn
+        self.slot = slot
+        self.future = None
+        self.submitted = time.monotonic()
+        self.started = None
+
+
+class Connection:
+    """A client, with its own queue of outgoing lines so slow readers only
+    hold up themselves."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.outgoing = asyncio.Queue()
+        self.jobs = set()
+        self.sender = asyncio.create_task(self.send_lines())
+
+    def send(self, message):
+        self.outgoing.put_nowait(json.dumps(message) + "\n")
+
+    async def send_lines(self):
+        try:
+            while True:
+                line = await self.outgoing.get()
+                self.writer.write(line.encode("utf-8"))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+
+
+def summarize(samples):
+    """Count, mean and percentiles of a list of seconds."""
+
+    if not samples:
+        return {"count": 0}
+
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "max": ordered[-1],
+    }
+
+
+class JobServer:
+    """
+    Accepts jobs from clients and runs them on a process pool.
+
+    jobs is the number of worker processes (one per core by default) and
+    max_pending the most jobs queued or running at once.
+    """
+
+    def __init__(self, jobs=None, max_pending=64):
+        self.workers = jobs or os.cpu_count() or 1
+        self.max_pending = max_pending
+
+        # one cancel flag per pending job slot, shared with the workers
+        self.cancel_flags = multiprocessing.RawArray("b", max_pending)
+        self.free_slots = list(range(max_pending))
+        self.events = multiprocessing.Queue()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=init_worker,
+            initargs=(self.events, self.cancel_flags))
+
+        self.jobs = {}
+        self.next_id = 0
+        self.counts = collections.Counter()
+        self.latency = collections.deque(maxlen=LATENCY_WINDOW)
+        self.queue_wait = collections.deque(maxlen=LATENCY_WINDOW)
+
+        self.loop = None
+        self.capacity = None
+        self.pump = None
+
+    async def start(self, path=None, host="127.0.0.1", port=0):
+        """Start listening on a Unix socket path, or on host:port."""
+
+        self.loop = asyncio.get_running_loop()
+        self.capacity = asyncio.Semaphore(self.max_pending)
+
+        # worker events are read on a thread and handed to the event loop
+        self.pump = threading.Thread(target=self.pump_events, daemon=True)
+        self.pump.start()
+
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_client, path)
+        return await asyncio.start_server(self.handle_client, host, port)
+
+    def close(self):
+        """Stop every job and the worker processes."""
+
+        for job in self.jobs.values():
+            self.cancel_flags[job.slot] = 1
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.events.put(None)
+        self.pump.join()
+
+    def pump_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            self.loop.call_soon_threadsafe(self.handle_event, *event)
+
+    def handle_event(self, job_id, kind, payload):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return
+
+        if kind == "started":
+            job.started = payload
+            wait = payload - job.submitted
+            self.queue_wait.append(wait)
+            job.conn.send({"id": job_id, "event": "started",
+                           "queue_wait": wait})
+        elif kind == "output":
+            job.conn.send({"id": job_id, "event": "output",
+                           "data": payload.decode("latin-1")})
+        elif kind == "done":
+            self.finish(job, payload)
+
+    def finish(self, job, result):
+        """Report a job's result and free its slot."""
+
+        del self.jobs[job.id]
+        job.conn.jobs.discard(job.id)
+        self.cancel_flags[job.slot] = 0
+        self.free_slots.append(job.slot)
+        self.capacity.release()
+
+        self.latency.append(time.monotonic() - job.submitted)
+        self.counts[result["exit"]] += 1
+
+        job.conn.send({"id": job.id, "event": "done", **result})
+
+    def job_failed(self, job, future):
+        """Called when a worker dies (or is shut down) under a job."""
+
+        if job.id not in self.jobs or future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            self.finish(job, {"exit": "error",
+                              "error": f"{type(error).__name__}: {error}"})
+
+    async def submit(self, conn, request):
+        """Queue a run request, waiting for a free slot first."""
+
+        job_id = request.get("id")
+        if job_id is None:
+            job_id = f"job{self.next_id}"
+            self.next_id += 1
+        job_id = str(job_id)
+
+        if job_id in self.jobs:
+            conn.send({"id": job_id, "event": "error",
+                       "message": "job id already in use"})
+            return
+
+        if "source" in request:
+            kind, program = "source", request["source"]
+        elif "image" in request:
+            kind, program = "image", base64.b64decode(request["image"])
+        else:
+            conn.send({"id": job_id, "event": "error",
+                       "message": "run needs a source or an image"})
+            return
+
+        # backpressure: don't read more requests until a slot is free
+        await self.capacity.acquire()
+
+        job = Job(job_id, conn, self.free_slots.pop())
+        self.jobs[job_id] = job
+        conn.jobs.add(job_id)
+
+        job.future = self.pool.submit(
+            run_job, job_id, job.slot, kind, program,
+            request.get("max_cycles"), request.get("timeout"))
+        job.future.add_done_callback(
+            lambda f: self.loop.call_soon_threadsafe(self.job_failed, job, f))
+
+        conn.send({"id": job_id, "event": "queued"})
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job. Returns False if it isn't known."""
+
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+
+        if job.future.cancel():
+            # never reached a worker
+            self.finish(job, {"exit": "cancelled", "error": None})
+        else:
+            # the worker notices between slices
+            self.cancel_flags[job.slot] = 1
+
+        return True
+
+    def stats(self):
+        running = sum(1 for job in self.jobs.values() if job.started is not None)
+
+        return {
+            "event": "stats",
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "queued": len(self.jobs) - running,
+            "running": running,
+            "finished": dict(self.counts),
+            "latency": summarize(self.latency),
+            "queue_wait": summarize(self.queue_wait),
+        }
+
+    async def handle_client(self, reader, writer):
+        conn = Connection(reader, writer)
+
+        try:
+            async for line in reader:
+                try:
+                    request = json.loads(line)
+                    op = request.get("op")
+                except (ValueError, AttributeError):
+                    conn.send({"event": "error", "message": "bad request"})
+                    continue
+
+                if op == "run":
+                    await self.submit(conn, request)
+                elif op == "cancel":
+                    job_id = str(request.get("id"))
+                    if self.cancel(job_id):
+                        conn.send({"id": job_id, "event": "cancelling"})
+                    else:
+                        conn.send({"id": job_id, "event": "error",
+                                   "message": "unknown job"})
+                elif op == "stats":
+                    conn.send(self.stats())
+                else:
+                    conn.send({"event": "error",
+                               "message": f"unknown op {op}"})
+        except (ConnectionError, asyncio.CancelledError):
+            # the client went away, or the server is shutting down
+            pass
+        finally:
+            # nobody is left to read the results
+            for job_id in list(conn.jobs):
+                self.cancel(job_id)
+            conn.sender.cancel()
+            conn.writer.close()
+
+
+async def serve(args):
+    server = JobServer(args.jobs, args.max_pending)
+    listener = await server.start(args.socket, port=args.port)
+
+    where = args.socket or "127.0.0.1:%d" % listener.sockets[0].getsockname()[1]
+    print(f"listening on {where}", file=sys.stderr)
+
+    # stop cleanly on SIGTERM as well as Ctrl-C
+    serving = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                                                  serving.cancel)
+
+    try:
+        async with listener:
+            await listener.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        server.close()
+
+
+def read_job(filename):
+    """Turn a program file into the fields of a run request."""
+
+    if filename.endswith(".asm"):
+        with open(filename) as f:
+            return {"source": f.read()}
+
+    if filename.endswith(".ls8b"):
+        with open(filename, "rb") as f:
+            data = f.read()
+    else:
+        data = image.pack_image(*image.read_listing(filename))
+
+    return {"image": base64.b64encode(data).decode("ascii")}
+
+
+async def submit(args):
+    """Send one program to a server, print its output and return its result."""
+
+    if args.socket:
+        reader, writer = await asyncio.open_unix_connection(args.socket)
+    else:
+        reader, writer = await asyncio.open_connection("127.0.0.1", args.port)
+
+    request = {"op": "run", "id": "1", "max_cycles": args.max_cycles,
+               "timeout": args.timeout, **read_job(args.program)}
+    writer.write((json.dumps(request) + "\n").encode("utf-8"))
+    await writer.drain()
+
+    result = None
+    async for line in reader:
+        message = json.loads(line)
+        if message.get("event") == "output":
+            sys.stdout.write(message["data"])
+        elif message.get("event") in ("done", "error"):
+            result = message
+            break
+
+    writer.close()
+    sys.stdout.flush()
+    print(json.dumps(result), file=sys.stderr)
+
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run LS-8 programs on a long-lived pool of workers.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="start the server")
+    serve_parser.add_argument("-j", "--jobs", type=int,
+                              help="worker processes (default: one per core)")
+    serve_parser.add_argument("--max-pending", type=int, default=64,
+                              help="most jobs queued or running at once")
+
+    submit_parser = commands.add_parser("submit", help="run one program")
+    submit_parser.add_argument("program", help=".asm, .ls8 or .ls8b file")
+    submit_parser.add_argument("--max-cycles", type=int,
+                               help="instruction limit for the program")
+    submit_parser.add_argument("--timeout", type=float,
+                               help="wall-time limit, in seconds")
+
+    for p in (serve_parser, submit_parser):
+        where = p.add_mutually_exclusive_group()
+        where.add_argument("--socket", help="Unix socket path")
+        where.add_argument("--port", type=int, default=8088,
+                           help="localhost TCP port (default 8088)")
+
+    args = parser.parse_args(argv[1:])
+
+    try:
+        if args.command == "serve":
+            asyncio.run(serve(args))
+        else:
+            result = asyncio.run(submit(args))
+            return 0 if result and result.get("exit") == "halted" else 1
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
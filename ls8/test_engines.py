@@ -0,0 +1,159 @@
+"""
+Every engine must run programs exactly like the plain CPU.
+
+Run with pytest from the repository root or from this directory.
+"""
+
+import glob
+import io
+import math
+import os
+
+import pytest
+
+from cpu import *
+from engines import ENGINES, conform, create
+from lockstep import HALTED, RUNNING, Lockstep
+from multicore import MultiCore
+
+EXAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "examples", "*.ls8")))
+
+# instructions each comparison runs at most: enough for every example to
+# halt, fail or go round its main loop many times
+MAX_CYCLES = 10_000
+
+# a program that rewrites the operand of its own LDI on every pass
+SELF_MODIFYING = """
+Loop:
+LDI R0,0
+PRN R0
+INC R0
+LDI R1,2
+ST R1,R0
+LDI R2,Loop
+JMP R2
+"""
+
+# a program that fails in the middle of a straight run of instructions
+FAULTING = """
+LDI R0,1
+LDI R1,0
+PRN R0
+DIV R0,R1
+PRN R0
+HLT
+"""
+
+OTHER_ENGINES = [name for name in ENGINES if name != "cpu"]
+
+# examples that halt, for the slower multi-process checks
+HALTING = [path for path in EXAMPLES
+           if os.path.basename(path) in ("call.ls8", "mult.ls8", "stack.ls8")]
+
+
+def example_id(program):
+    if program == SELF_MODIFYING:
+        return "self-modifying"
+    if program == FAULTING:
+        return "faulting"
+    return os.path.basename(program)
+
+
+def loaded(name, program):
+    """A CPU on the named engine with program, a path or assembly source."""
+
+    cpu = create(name)
+    if program.endswith(".ls8"):
+        cpu.load(program)
+    else:
+        cpu.load_asm(program)
+    return cpu
+
+
+@pytest.mark.parametrize("program", EXAMPLES, ids=example_id)
+@pytest.mark.parametrize("name", OTHER_ENGINES)
+def test_conforms_on_examples(name, program):
+    divergence = conform(loaded("cpu", program), loaded(name, program),
+                         MAX_CYCLES)
+    assert divergence is None
+
+
+@pytest.mark.parametrize("program", [SELF_MODIFYING, FAULTING],
+                         ids=example_id)
+@pytest.mark.parametrize("name", OTHER_ENGINES)
+def test_conforms_on_edge_cases(name, program):
+    divergence = conform(loaded("cpu", program), loaded(name, program),
+                         MAX_CYCLES)
+    assert divergence is None
+
+
+@pytest.mark.parametrize("program", EXAMPLES + [SELF_MODIFYING, FAULTING],
+                         ids=example_id)
+def test_block_conforms_running_several_blocks_at_once(program):
+    # the block engine may overshoot a limit, so it is checked a stretch of
+    # instructions at a time
+    divergence = conform(loaded("cpu", program), loaded("block", program),
+                         MAX_CYCLES, step=7)
+    assert divergence is None
+
+
+@pytest.mark.parametrize("program", EXAMPLES, ids=example_id)
+def test_instrumented_debugger_conforms(program):
+    # a condition that never holds keeps the debugger on its own loop
+    # instead of handing over to CPU.run()
+    debug = loaded("debug", program)
+    debug.add_condition(lambda cpu: False)
+    divergence = conform(loaded("cpu", program), debug, MAX_CYCLES)
+    assert divergence is None
+
+
+def run_cpu(program):
+    """Run program on the plain CPU with the timer stopped, like conform()."""
+
+    cpu = loaded("cpu", program)
+    cpu.timer.interval = math.inf
+    cpu.timer.set_state(math.inf)
+    output = io.StringIO()
+    cpu.set_output(OutputDevice(output))
+    try:
+        reason = cpu.run(max_cycles=MAX_CYCLES)
+    except Exception:
+        reason = "error"
+    return cpu, reason, output.getvalue()
+
+
+@pytest.mark.parametrize("program", EXAMPLES, ids=example_id)
+def test_lockstep_matches_cpu(program):
+    cpu, reason, output = run_cpu(program)
+
+    machines = Lockstep.load(program, 3)
+    machines.run(MAX_CYCLES)
+
+    status = {"halted": HALTED, "max_cycles": RUNNING}.get(reason)
+    for row in range(3):
+        if status is None:
+            assert machines.status[row] not in (HALTED, RUNNING)
+        else:
+            assert machines.status[row] == status
+        assert "".join(machines.output[row]) == output
+        assert machines.cycles[row] == cpu.cycles
+        assert machines.pc[row] == cpu.pc
+        assert bytes(machines.reg[row]) == bytes(cpu.reg)
+        assert bytes(machines.ram[row]) == bytes(cpu.ram)
+    assert machines.symbols == cpu.symbols
+
+
+@pytest.mark.parametrize("program", HALTING, ids=example_id)
+def test_single_core_machine_matches_cpu(program):
+    cpu, reason, output = run_cpu(program)
+
+    with MultiCore(cores=1) as machine:
+        machine.load(program)
+        result, = machine.run(max_cycles=MAX_CYCLES)
+
+    assert result["reason"] == reason == "halted"
+    assert result["output"] == output
+    assert result["cycles"] == cpu.cycles
+    assert result["pc"] == cpu.pc
+    assert result["reg"] == list(cpu.reg)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Decode binary LS-8 traces written by tracer.py.
+
+Usage:
+    tracedecode.py trace.bin [--pc LO-HI] [--op NAME]
+    tracedecode.py trace.bin --diff other.bin
+"""
+
+import argparse
+import sys
+
+from cpu import instr
+from tracer import RECORD, TRACE_HEADER, TRACE_MAGIC, TRACE_VERSION
+
+
+def read_trace(filename):
+    """Return the records in a trace file as (pc, ir, a, b, regs, fl) tuples."""
+
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    magic, version, size = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or size != RECORD.size:
+        raise Exception(f"{filename}: not an LS-8 trace")
+
+    body = memoryview(data)[TRACE_HEADER.size:]
+    body = body[:len(body) - len(body) % RECORD.size]
+
+    return [(pc, ops[0], ops[1], ops[2], regs, fl)
+            for pc, ops, regs, fl in RECORD.iter_unpack(body)]
+
+
+def format_record(record):
+    """Format a record the way CPU.trace() prints the live state."""
+
+    pc, ir, a, b, regs, fl = record
+    line = "TRACE: %02X | %02X %02X %02X |" % (pc, ir, a, b)
+    return line + "".join(" %02X" % r for r in regs)
+
+
+def parse_range(text):
+    """Parse "LO-HI" (hex or decimal, either end optional) into a range."""
+
+    lo, _, hi = text.partition("-")
+    lo = int(lo, 0) if lo else 0
+    hi = int(hi, 0) if hi else (lo if "-" not in text else 255)
+    return range(lo, hi + 1)
+
+
+def filter_records(records, pcs=None, op=None):
+    """Keep records whose PC is in pcs and whose opcode is named op."""
+
+    if op is not None:
+        op = op.upper()
+
+    for record in records:
+        if pcs is not None and record[0] not in pcs:
+            continue
+        if op is not None and instr.get(record[1]) != op:
+            continue
+        yield record
+
+
+def diff_traces(a, b, out=sys.stdout, context=3):
+    """
+    Compare two traces record by record and print the first divergence
+    with a few records of context. Returns the index of the first differing
+    record, or None if the traces match.
+    """
+
+    for i, (ra, rb) in enumerate(zip(a, b)):
+        if ra != rb:
+            break
+    else:
+        if len(a) == len(b):
+            print("traces match", file=out)
+            return None
+        i = min(len(a), len(b))
+
+    print(f"traces diverge at record {i}", file=out)
+    for j in range(max(0, i - context), i + 1):
+        marker = ">" if j == i else " "
+        left = format_record(a[j]) if j < len(a) else "(end of trace)"
+        right = format_record(b[j]) if j < len(b) else "(end of trace)"
+        print(f"{marker} {j:8d}  {left}", file=out)
+        if left != right:
+            print(f"  {'':8s}  {right}", file=out)
+
+    return i
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Decode binary LS-8 traces into TRACE: lines.")
+    parser.add_argument("trace", help="trace file written by tracer.py")
+    parser.add_argument("--pc", type=parse_range,
+                        help="only show records with PC in LO-HI")
+    parser.add_argument("--op", help="only show records for this opcode")
+    parser.add_argument("--diff", metavar="OTHER",
+                        help="report where this trace and OTHER diverge")
+    args = parser.parse_args(argv[1:])
+
+    records = read_trace(args.trace)
+
+    if args.diff:
+        return 0 if diff_traces(records, read_trace(args.diff)) is None else 1
+
+    for record in filter_records(records, args.pc, args.op):
+        print(format_record(record))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
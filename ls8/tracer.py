@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+"""
+Binary execution trace recorder for the LS-8.
+
+Usage: tracer.py program.ls8 trace.bin [--last N] [--max-cycles N]
+"""
+
+import argparse
+import struct
+import sys
+
+from cpu import *
+
+# One record per executed instruction: PC, the three bytes at PC (IR and
+# both operands, zero padded at the top of RAM), R0-R7 and FL
+RECORD = struct.Struct("<B3s8sB")
+
+# Trace files are a magic number, version and record size, then records
+TRACE_MAGIC = b"LS8T"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sBB")
+
+
+class TraceRecorder:
+    """
+    Fixed-width binary records in a preallocated buffer.
+
+    Without a file the buffer is a ring holding the last `capacity`
+    instructions. With a file (opened "wb") it is an append-only log: every
+    time the buffer fills it is written out and reused.
+    """
+
+    def __init__(self, capacity=65536, file=None):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.offset = 0         # byte offset of the next record
+        self.total = 0          # records in earlier passes over the buffer
+        self.file = file
+
+        if file is not None:
+            file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION,
+                                         RECORD.size))
+
+    def wrap(self):
+        """Called by the run loop when the buffer is full."""
+
+        if self.file is not None:
+            self.file.write(self.buffer)
+        self.total += self.capacity
+        self.offset = 0
+
+    def flush(self):
+        """Write buffered records to the file, if there is one."""
+
+        if self.file is not None and self.offset:
+            self.file.write(memoryview(self.buffer)[:self.offset])
+            self.total += self.offset // RECORD.size
+            self.offset = 0
+            self.file.flush()
+
+    def count(self):
+        """Number of instructions recorded so far."""
+        return self.total + self.offset // RECORD.size
+
+    def records(self):
+        """The records still in the buffer, oldest first, as bytes."""
+
+        if self.total and self.file is None:
+            return bytes(self.buffer[self.offset:] + self.buffer[:self.offset])
+        return bytes(self.buffer[:self.offset])
+
+    def dump(self, filename):
+        """Write the records still in the buffer to a trace file."""
+
+        with open(filename, "wb") as f:
+            f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, RECORD.size))
+            f.write(self.records())
+
+
+class TracingCPU(CPU):
+    """
+    CPU whose run() records every instruction to a TraceRecorder.
+
+    Each instruction costs one struct.pack_into into the preallocated
+    buffer, cheap enough to leave on and dump the last instructions after a
+    crash. The records decode with tracedecode.py.
+    """
+
+    def __init__(self, recorder=None):
+        super().__init__()
+        self.recorder = recorder if recorder is not None else TraceRecorder()
+        # record idle loops like everything else
+        self.skip_idle = False
+
+    def fork(self):
+        # the child records into a ring of its own the same size; a trace
+        # file only has room for one machine
+        child = super().fork()
+        child.recorder = TraceRecorder(self.recorder.capacity)
+        return child
+
+    def run(self, max_cycles=None, timeout=None):
+        """Run the CPU like CPU.run(), recording each instruction."""
+
+        pc, cycles, next_poll = self.start_run(max_cycles, timeout)
+
+        recorder = self.recorder
+        buf = recorder.buffer
+        end = len(buf)
+        off = recorder.offset
+        pack_into = RECORD.pack_into
+        size = RECORD.size
+
+        ram = self.ram
+        reg = self.reg
+        execute = self.execute
+        interrupts = self.interrupts
+
+        try:
+            while True:
+                if cycles >= next_poll:
+                    stopped, cycles, next_poll = self.poll_point(pc, cycles)
+                    if stopped:
+                        return stopped
+
+                if interrupts.pending:
+                    pc = self.interrupt_point(pc)
+
+                pack_into(buf, off, pc, ram[pc:pc + 3], reg, self.fl)
+                off += size
+                if off == end:
+                    recorder.wrap()
+                    off = 0
+
+                cycles += 1
+                pc = execute(pc)
+        except Halted:
+            return "halted"
+        finally:
+            self.end_run(pc, cycles)
+            recorder.offset = off
+            recorder.flush()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Run an LS-8 program, recording a binary trace.")
+    parser.add_argument("program", help=".ls8 or .ls8b file")
+    parser.add_argument("trace", help="trace file to write")
+    parser.add_argument("--last", type=int,
+                        help="keep only the last N instructions (ring buffer)")
+    parser.add_argument("--max-cycles", type=int,
+                        help="stop after this many instructions")
+    args = parser.parse_args(argv[1:])
+
+    if args.last:
+        cpu = TracingCPU(TraceRecorder(args.last))
+        cpu.load(args.program)
+        try:
+            cpu.run(max_cycles=args.max_cycles)
+        finally:
+            cpu.recorder.dump(args.trace)
+    else:
+        with open(args.trace, "wb") as f:
+            cpu = TracingCPU(TraceRecorder(file=f))
+            cpu.load(args.program)
+            cpu.run(max_cycles=args.max_cycles)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
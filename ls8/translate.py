@@ -0,0 +1,198 @@
+"""Basic-block translation engine for the LS-8."""
+
+from cpu import *
+
+# longest run of instructions compiled into a single block
+MAX_BLOCK = 64
+
+# instructions that write to RAM, generated code checks for self-modification
+# after each of them
+RAM_WRITERS = {"PUSH", "ST"}
+
+# instructions that always end a block: they either stop the CPU or change
+# the interrupt state, which has to be checked before the next instruction
+BLOCK_ENDERS = {"HLT", "INT", "IRET"}
+
+
+class BlockCPU(CPU):
+    """
+    CPU that compiles straight-line runs of instructions into Python functions.
+
+    A block starts at an entry PC and runs up to and including the next
+    instruction that sets the PC (the C bit of the opcode). Blocks are cached
+    by start address, so a loop only pays the fetch/decode cost the first
+    time through. Writes to RAM covered by a cached block throw that block
+    away, so self-modifying programs still behave like CPU.run().
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.blocks = {}                        # start address -> function
+        self.block_ends = {}                    # start address -> end address
+        self.covering = [set() for _ in range(256)]
+        # bumped on every invalidation so a running block can notice
+        self.generation = [0]
+
+    def load(self, filename=None):
+        super().load(filename)
+        self.flush()
+
+    def load_image(self, source):
+        super().load_image(source)
+        self.flush()
+
+    def restore(self, state, offset=0):
+        super().restore(state, offset)
+        self.flush()
+
+    def ram_write(self, val, addr):
+        super().ram_write(val, addr)
+        if self.covering[addr]:
+            self.invalidate(addr)
+
+    def flush(self):
+        """Throw away every translated block."""
+
+        self.blocks.clear()
+        self.block_ends.clear()
+        for start_addrs in self.covering:
+            start_addrs.clear()
+        self.generation[0] += 1
+
+    def invalidate(self, addr):
+        """Throw away every translated block that covers the given address."""
+
+        for start in list(self.covering[addr]):
+            end = self.block_ends.pop(start)
+            del self.blocks[start]
+            for a in range(start, end):
+                self.covering[a].discard(start)
+        self.generation[0] += 1
+
+    def translate(self, start):
+        """
+        Decode the instructions from start up to the end of the basic block and
+        compile them into a function that returns the next PC and the number
+        of instructions it executed. The function is cached for start and
+        returned.
+        """
+
+        ram = self.ram
+        namespace = {"cpu": self, "reg": self.reg,
+                     "generation": self.generation}
+        lines = [f"def block_{start:02x}():",
+                 f"    gen = generation[0]"]
+        # source line -> (PC, instructions executed) should the line raise
+        faults = {}
+
+        pc = start
+        count = 0
+        while True:
+            ir = ram[pc]
+            handler, num_operands, sets_pc = self.dispatch[ir]
+            name = instr.get(ir)
+            next_pc = pc + num_operands + 1
+            first_line = len(lines) + 1
+
+            if next_pc > len(ram):
+                # operands run off the end of RAM
+                lines.append(f"    cpu.ram_read({next_pc - 1})")
+                faults[len(lines)] = (pc, count + 1)
+                break
+
+            operands = [ram[pc + 1 + i] for i in range(num_operands)]
+            args = ", ".join(str(o) for o in operands)
+            namespace[f"h{count}"] = handler
+
+            if sets_pc:
+                lines.append(f"    cpu.pc = {pc}")
+                lines.append(f"    h{count}({args})")
+                lines.append(f"    return cpu.pc, {count + 1}")
+                for line in range(first_line, len(lines) + 1):
+                    faults[line] = (pc, count + 1)
+                break
+
+            if name == "LDI" and operands[0] <= 7 and operands[0] not in (IM, IS):
+                lines.append(f"    reg[{operands[0]}] = {operands[1]}")
+            else:
+                lines.append(f"    h{count}({args})")
+
+            count += 1
+            for line in range(first_line, len(lines) + 1):
+                faults[line] = (pc, count)
+
+            if name in RAM_WRITERS:
+                # stop straight after an instruction that changed this block
+                lines.append(f"    if generation[0] != gen:")
+                lines.append(f"        return {next_pc}, {count}")
+
+            if (name is None or name in BLOCK_ENDERS or count == MAX_BLOCK
+                    or (num_operands and operands[0] in (IM, IS))
+                    or next_pc >= len(ram)):
+                # invalid instruction, interrupt state change, or long block
+                lines.append(f"    return {next_pc}, {count}")
+                break
+
+            pc = next_pc
+
+        end = min(next_pc, len(ram))
+        exec(compile("\n".join(lines), f"<block {start:02x}>", "exec"),
+             namespace)
+        block = namespace[f"block_{start:02x}"]
+        block.start = start
+        block.faults = faults
+
+        self.blocks[start] = block
+        self.block_ends[start] = end
+        for a in range(start, end):
+            self.covering[a].add(start)
+
+        return block
+
+    def fault(self, block, error):
+        """
+        Where in block an instruction raised error: its PC and the number of
+        instructions executed up to and including it, as CPU.run() counts.
+        """
+
+        tb = error.__traceback__
+        while tb is not None:
+            if tb.tb_frame.f_code is block.__code__:
+                return block.faults.get(tb.tb_lineno, (block.start, 0))
+            tb = tb.tb_next
+        return block.start, 0
+
+    def run(self, max_cycles=None, timeout=None):
+        """Run the CPU one translated block at a time. See CPU.run()."""
+
+        pc, cycles, next_poll = self.start_run(max_cycles, timeout)
+
+        blocks = self.blocks
+        interrupts = self.interrupts
+
+        try:
+            while True:
+                if cycles >= next_poll:
+                    stopped, cycles, next_poll = self.poll_point(pc, cycles)
+                    if stopped:
+                        return stopped
+
+                if interrupts.pending:
+                    pc = self.interrupt_point(pc)
+
+                block = blocks.get(pc)
+                if block is None:
+                    block = self.translate(pc)
+                try:
+                    pc, executed = block()
+                except BaseException as e:
+                    # stop at the instruction that raised, like CPU.run()
+                    pc, executed = self.fault(block, e)
+                    cycles += executed
+                    raise
+                cycles += executed
+        except Halted:
+            return "halted"
+        finally:
+            self.end_run(pc, cycles)